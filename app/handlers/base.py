@@ -2,10 +2,11 @@ import os
 import random
 import logging
 import io
-from datetime import datetime, timezone
+import html
 
 from aiogram import Router, types, F, Bot
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
@@ -14,63 +15,125 @@ from aiogram.types import (
     CallbackQuery
 )
 
+from app.middlewares.metrics import MetricsMiddleware
+from app.middlewares.rate_limit import RateLimitMiddleware
+from app.services import broadcast, image_cache, image_pipeline, jobs, progress, reputation
 from app.services.db import get_db
+from app.services.http import get_session, close_session
 from app.services.ai_image import (
     generate_best,
     hf_image_process,
     hf_img2img,
     hf_remove_bg,
+    gen_key,
+    img2img_key,
+    remove_bg_key,
+    process_key,
+    pick_input_photo,
+    IMG2IMG_MODEL,
+    REMOVE_BG_MODEL,
     GFPGAN_MODEL,
     ESRGAN_MODEL
 )
 
 base_router = Router()
+# Общая HTTP-сессия для инференса живет столько же, сколько бот
+base_router.startup.register(get_session)
+base_router.startup.register(reputation.start)
+base_router.startup.register(broadcast.start)
+base_router.shutdown.register(jobs.stop_workers)
+base_router.shutdown.register(reputation.stop)
+base_router.shutdown.register(broadcast.stop)
+base_router.shutdown.register(close_session)
+# Лимиты на дорогие команды (флаг rate_limit у хэндлера)
+base_router.message.middleware(RateLimitMiddleware())
+base_router.callback_query.middleware(RateLimitMiddleware())
+# Если роутер подключен к диспетчеру со своим MetricsMiddleware, замер не задвоится
+base_router.message.middleware(MetricsMiddleware())
+base_router.callback_query.middleware(MetricsMiddleware())
 
-# Кэш для кулдауна генерации
-GEN_COOLDOWN = {}
-COOLDOWN_SEC = 20
+# Нажатия кнопок, которые сейчас обрабатываются: (user_id, chat_id, message_id, действие)
+ACTIVE_PRESSES = set()
+# Строк на странице рейтинга и списка покупок
+PAGE_SIZE = 10
+MAX_ITEM_LENGTH = 200
+
+# Утренняя мотивация во все чаты, где запускали /start (см. broadcast.schedule_motivation)
+broadcast.schedule_motivation()
 
 # ====== ИНИЦИАЛИЗАЦИЯ БД ======
 async def init_db():
-    """Создает необходимые таблицы при запуске бота"""
-    pool = await get_db()
-    async with pool.acquire() as conn:
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS reputation (
-            user_id BIGINT PRIMARY KEY,
-            name TEXT,
-            score INTEGER DEFAULT 0
-        )
-        """)
-        await conn.execute("""
-        CREATE TABLE IF NOT EXISTS shopping_list (
-            id SERIAL PRIMARY KEY,
-            item TEXT
-        )
-        """)
+    """Подключается к базе при запуске бота; схему доводят миграции (app/services/migrations.py)"""
+    await get_db()
     logging.info("✅ База данных инициализирована")
 
-# ====== ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ (/gen) ======
-@base_router.message(Command("gen"))
-async def cmd_generate(message: Message):
-    prompt = message.text.replace("/gen", "").strip()
-    if not prompt:
-        return await message.answer("📝 Введи описание. Пример: <code>/gen cyberpunk city</code>")
+# ====== ОТПРАВКА РЕЗУЛЬТАТОВ ======
+async def send_result(message: Message, key: str, produce, filename: str, caption: str,
+                      reply_markup=None, as_document: bool = False):
+    """Отправляет результат: готовый file_id из кэша или новую загрузку. None — если результата нет"""
+    send = message.answer_document if as_document else message.answer_photo
+
+    file_id = image_cache.get_file_id(key)
+    if file_id:
+        try:
+            return await send(file_id, caption=caption, reply_markup=reply_markup)
+        except TelegramBadRequest:
+            image_cache.forget_file_id(key)
+
+    result = await produce()
+    if not result:
+        return None
 
-    uid = message.from_user.id
-    now = datetime.now(timezone.utc).timestamp()
+    # Расширение по фактическому формату: провайдер мог отдать JPEG или WebP
+    filename = f"{os.path.splitext(filename)[0]}.{image_pipeline.extension(result)}"
+    sent = await send(BufferedInputFile(result, filename=filename), caption=caption, reply_markup=reply_markup)
+    media = sent.document if as_document else sent.photo[-1]
+    image_cache.remember_file_id(key, media.file_id)
+    return sent
 
-    if uid in GEN_COOLDOWN and now - GEN_COOLDOWN[uid] < COOLDOWN_SEC:
-        return await message.answer(f"⏳ Подожди {int(COOLDOWN_SEC - (now - GEN_COOLDOWN[uid]))} сек.")
+# ====== ОЧЕРЕДЬ ЗАДАЧ ======
+async def enqueue(status: progress.Progress, priority: int, run, on_done=None) -> bool:
+    """Ставит обработку в общую очередь; хэндлер сразу освобождается.
 
-    GEN_COOLDOWN[uid] = now
-    status = await message.answer("🎨 Мастерю шедевр...")
+    Статусное сообщение показывает место в очереди и время работы, а по
+    завершении (или отмене) удаляется; on_done — дополнительная уборка.
+    """
+    async def done():
+        await status.finish()
+        if on_done:
+            on_done()
 
-    image = await generate_best(f"{prompt}, ultra detailed, masterpiece")
+    job = jobs.submit(status.user_id, priority, run, on_position=status.set_position, on_done=done)
+    if job is None:
+        status.fail("⏳ У тебя уже есть задачи в очереди, дождись результата.")
+        await done()
+        return False
+    status.job = job
+    return True
 
-    if not image:
-        return await status.edit_text("❌ Сервис генерации временно недоступен.")
+@base_router.callback_query(F.data.startswith("cancel_job:"))
+async def cancel_job(call: CallbackQuery):
+    status = progress.get(int(call.data.split(":", 1)[1]))
+    if status is None or status.job is None:
+        return await call.answer("Задача уже завершена")
+    if status.user_id != call.from_user.id:
+        return await call.answer("Отменить может только автор запроса")
+    if not jobs.cancel(status.job):
+        return await call.answer("Задача уже завершена")
+    status.fail("✖️ Отменено")
+    await call.answer("✖️ Отменено")
 
+# Лимит списывается только за команду с корректными аргументами: проверки —
+# в фильтрах, а подсказки по использованию отдают хэндлеры без rate_limit ниже
+
+# ====== ГЕНЕРАЦИЯ ИЗОБРАЖЕНИЙ (/gen) ======
+@base_router.message(Command("gen", magic=F.args), flags={"rate_limit": "gen"})
+async def cmd_generate(message: Message, command: CommandObject):
+    prompt = command.args.strip()
+
+    status = await progress.report(message, "🎨 Мастерю шедевр...")
+
+    full_prompt = f"{prompt}, ultra detailed, masterpiece"
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="✨ Лицо", callback_data="facefix"),
@@ -78,104 +141,127 @@ async def cmd_generate(message: Message):
         ]
     ])
 
-    await message.answer_photo(
-        BufferedInputFile(image, filename="gen.png"),
-        caption=f"✨ <b>Готово!</b>\nЗапрос: <i>{prompt}</i>",
-        reply_markup=kb
-    )
-    await status.delete()
+    async def run():
+        sent = await send_result(
+            message, gen_key(full_prompt), lambda: generate_best(full_prompt), "gen.png",
+            caption=f"✨ <b>Готово!</b>\nЗапрос: <i>{prompt}</i>",
+            reply_markup=kb
+        )
 
-# ====== СТИЛИЗАЦИЯ (/style) ======
-@base_router.message(Command("style"))
-async def cmd_style(message: Message):
-    prompt = message.text.replace("/style", "").strip()
-    if not prompt:
-        return await message.answer("🎨 Напиши стиль! Пример: (в ответ на фото) <code>/style аниме</code>")
+        if not sent:
+            status.fail("❌ Сервис генерации временно недоступен.")
 
-    if not message.reply_to_message or not message.reply_to_message.photo:
-        return await message.answer("⚠️ Ответь этой командой на фотографию!")
+    await enqueue(status, jobs.PRIORITY_HEAVY, run)
 
-    status = await message.answer("⚡ Перерисовываю...")
+@base_router.message(Command("gen"))
+async def cmd_generate_usage(message: Message):
+    await message.answer("📝 Введи описание. Пример: <code>/gen cyberpunk city</code>")
+
+# ====== СТИЛИЗАЦИЯ (/style) ======
+@base_router.message(Command("style", magic=F.args), F.reply_to_message.photo, flags={"rate_limit": "style"})
+async def cmd_style(message: Message, command: CommandObject):
+    prompt = command.args.strip()
+
+    status = await progress.report(message, "⚡ Перерисовываю...")
     
-    try:
-        photo = message.reply_to_message.photo[-1]
-        file_dest = io.BytesIO()
-        await message.bot.download(photo, destination=file_dest)
-        
-        result = await hf_img2img(file_dest.getvalue(), prompt)
-        
-        if result:
-            await message.answer_photo(
-                BufferedInputFile(result, filename="styled.png"),
+    async def run():
+        try:
+            photo = pick_input_photo(message.reply_to_message.photo, IMG2IMG_MODEL)
+            file_dest = io.BytesIO()
+            await message.bot.download(photo, destination=file_dest)
+            
+            image_bytes = file_dest.getbuffer()
+            
+            sent = await send_result(
+                message, img2img_key(image_bytes, prompt), lambda: hf_img2img(image_bytes, prompt), "styled.png",
                 caption=f"🎨 <b>Стиль:</b> {prompt}"
             )
-        else:
-            await message.answer("❌ Ошибка стилизации. Попробуй позже.")
-    except Exception as e:
-        logging.error(f"Style error: {e}")
-        await message.answer("❌ Произошла ошибка при обработке.")
-    finally:
-        await status.delete()
+            
+            if not sent:
+                await message.answer("❌ Ошибка стилизации. Попробуй позже.")
+        except Exception as e:
+            logging.error(f"Style error: {e}")
+            await message.answer("❌ Произошла ошибка при обработке.")
+
+    await enqueue(status, jobs.PRIORITY_NORMAL, run)
+
+@base_router.message(Command("style"))
+async def cmd_style_usage(message: Message):
+    if not message.text.replace("/style", "").strip():
+        return await message.answer("🎨 Напиши стиль! Пример: (в ответ на фото) <code>/style аниме</code>")
+    await message.answer("⚠️ Ответь этой командой на фотографию!")
 
 # ====== УДАЛЕНИЕ ФОНА (/nobg) ======
-@base_router.message(Command("nobg"))
+@base_router.message(Command("nobg"), F.reply_to_message.photo, flags={"rate_limit": "nobg"})
 async def cmd_remove_bg(message: Message):
-    if not message.reply_to_message or not message.reply_to_message.photo:
-        return await message.answer("✂️ Ответь этой командой на фото!")
+    status = await progress.report(message, "✂️ Вырезаю объект...")
 
-    status = await message.answer("✂️ Вырезаю объект...")
-    try:
-        photo = message.reply_to_message.photo[-1]
+    async def run():
+        try:
+            photo = pick_input_photo(message.reply_to_message.photo, REMOVE_BG_MODEL)
+            file_dest = io.BytesIO()
+            await message.bot.download(photo, destination=file_dest)
+            
+            image_bytes = file_dest.getbuffer()
+            
+            sent = await send_result(
+                message, remove_bg_key(image_bytes), lambda: hf_remove_bg(image_bytes), "no_bg.png",
+                caption="✨ Фон успешно удален!", as_document=True
+            )
+            
+            if not sent:
+                await message.answer("❌ Не удалось убрать фон.")
+        except Exception as e:
+            logging.error(f"NoBG error: {e}")
+            await message.answer("❌ Ошибка при удалении фона.")
+
+    await enqueue(status, jobs.PRIORITY_FAST, run)
+
+@base_router.message(Command("nobg"))
+async def cmd_remove_bg_usage(message: Message):
+    await message.answer("✂️ Ответь этой командой на фото!")
+
+# ====== CALLBACKS (УЛУЧШЕНИЕ) ======
+def claim_press(call: CallbackQuery):
+    """Ключ нажатия или None, если такое же нажатие этого пользователя уже в работе"""
+    press = (call.from_user.id, call.message.chat.id, call.message.message_id, call.data)
+    if press in ACTIVE_PRESSES:
+        return None
+    ACTIVE_PRESSES.add(press)
+    return press
+
+async def enhance(call: CallbackQuery, model: str, text: str, filename: str, caption: str, error: str):
+    """Общая обработка кнопок «Лицо» и «Апскейл»"""
+    if not call.message.photo: return await call.answer()
+    press = claim_press(call)
+    if not press: return await call.answer("⏳ Уже обрабатываю, подожди...")
+    await call.answer()
+
+    # Сообщение с картинкой — от бота: отменять задачу может тот, кто нажал кнопку
+    status = await progress.report(call.message, text, user_id=call.from_user.id)
+
+    async def run():
         file_dest = io.BytesIO()
-        await message.bot.download(photo, destination=file_dest)
+        await call.bot.download(pick_input_photo(call.message.photo, model), destination=file_dest)
         
-        result = await hf_remove_bg(file_dest.getvalue())
+        image_bytes = file_dest.getbuffer()
         
-        if result:
-            await message.answer_document(
-                BufferedInputFile(result, filename="no_bg.png"),
-                caption="✨ Фон успешно удален!"
-            )
-        else:
-            await message.answer("❌ Не удалось убрать фон.")
-    except Exception as e:
-        logging.error(f"NoBG error: {e}")
-        await message.answer("❌ Ошибка при удалении фона.")
-    finally:
-        await status.delete()
+        sent = await send_result(
+            call.message, process_key(image_bytes, model), lambda: hf_image_process(image_bytes, model),
+            filename, caption=caption
+        )
+        if not sent:
+            await call.message.answer(error)
 
-# ====== CALLBACKS (УЛУЧШЕНИЕ) ======
-@base_router.callback_query(F.data == "facefix")
+    await enqueue(status, jobs.PRIORITY_NORMAL, run, on_done=lambda: ACTIVE_PRESSES.discard(press))
+
+@base_router.callback_query(F.data == "facefix", flags={"rate_limit": "enhance"})
 async def facefix(call: CallbackQuery):
-    await call.answer()
-    if not call.message.photo: return
-    
-    status = await call.message.answer("✨ Исправляю лицо...")
-    file_dest = io.BytesIO()
-    await call.bot.download(call.message.photo[-1], destination=file_dest)
-    
-    result = await hf_image_process(file_dest.getvalue(), GFPGAN_MODEL)
-    if result:
-        await call.message.answer_photo(BufferedInputFile(result, filename="fixed.png"), caption="✨ Лицо улучшено")
-    else:
-        await call.message.answer("❌ Ошибка обработки лица.")
-    await status.delete()
-
-@base_router.callback_query(F.data == "upscale")
+    await enhance(call, GFPGAN_MODEL, "✨ Исправляю лицо...", "fixed.png", "✨ Лицо улучшено", "❌ Ошибка обработки лица.")
+
+@base_router.callback_query(F.data == "upscale", flags={"rate_limit": "enhance"})
 async def upscale(call: CallbackQuery):
-    await call.answer()
-    if not call.message.photo: return
-    
-    status = await call.message.answer("🔍 Увеличиваю качество...")
-    file_dest = io.BytesIO()
-    await call.bot.download(call.message.photo[-1], destination=file_dest)
-    
-    result = await hf_image_process(file_dest.getvalue(), ESRGAN_MODEL)
-    if result:
-        await call.message.answer_photo(BufferedInputFile(result, filename="big.png"), caption="🔍 Качество улучшено")
-    else:
-        await call.message.answer("❌ Ошибка апскейла.")
-    await status.delete()
+    await enhance(call, ESRGAN_MODEL, "🔍 Увеличиваю качество...", "big.png", "🔍 Качество улучшено", "❌ Ошибка апскейла.")
 
 # ====== РЕПУТАЦИЯ И СИСТЕМА ======
 @base_router.message(F.text == "+")
@@ -183,21 +269,123 @@ async def add_rep(message: Message):
     if not message.reply_to_message or message.reply_to_message.from_user.id == message.from_user.id:
         return
     
-    pool = await get_db()
     target_user = message.reply_to_message.from_user
-    
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO reputation (user_id, name, score) 
-            VALUES ($1, $2, 1) 
-            ON CONFLICT (user_id) 
-            DO UPDATE SET score = reputation.score + 1
-        """, target_user.id, target_user.first_name)
+    # Без обращения к базе: начисления сбрасываются пачкой раз в пару секунд
+    reputation.add(target_user.id, target_user.first_name)
     
     await message.answer(f"👍 Репутация <b>{target_user.first_name}</b> увеличена!")
 
+def top_page(rows: list, start: int):
+    """Текст страницы рейтинга и кнопка следующей страницы (курсор — последняя строка)"""
+    lines = [
+        f"{place}. {html.escape(name or '—')} — <b>{score}</b>"
+        for place, (_, name, score) in enumerate(rows, start=start)
+    ]
+    kb = None
+    if len(rows) == PAGE_SIZE:
+        user_id, _, score = rows[-1]
+        kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="Дальше ▶", callback_data=f"top:{score}:{user_id}:{start + PAGE_SIZE}")
+        ]])
+    return "🏆 <b>Рейтинг семьи</b>\n\n" + "\n".join(lines), kb
+
+@base_router.message(Command("top"))
+async def cmd_top(message: Message):
+    # Все страницы — одним keyset-запросом, чтобы курсор «Дальше» совпадал с показанным
+    rows = await reputation.page(limit=PAGE_SIZE)
+    if not rows:
+        return await message.answer("🏆 Пока никто не получил репутацию. Ответь «+» на сообщение!")
+    text, kb = top_page(rows, 1)
+    await message.answer(text, reply_markup=kb)
+
+@base_router.callback_query(F.data.startswith("top:"))
+async def top_next(call: CallbackQuery):
+    _, score, user_id, start = call.data.split(":")
+    rows = await reputation.page(int(score), int(user_id), PAGE_SIZE)
+    if not rows:
+        return await call.answer("Это конец списка")
+    text, kb = top_page(rows, int(start))
+    await call.message.edit_text(text, reply_markup=kb)
+    await call.answer()
+
+@base_router.message(Command("rep"))
+async def cmd_rep(message: Message):
+    target = message.reply_to_message.from_user if message.reply_to_message else message.from_user
+    score = await reputation.score(target.id)
+    await message.answer(f"⭐ Репутация <b>{html.escape(target.first_name)}</b>: {score}")
+
+# ====== СПИСОК ПОКУПОК ======
+async def shopping_page(after_id: int = 0):
+    """Страница списка после after_id: текст и кнопки удаления/перехода"""
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, item FROM shopping_list WHERE id > $1 ORDER BY id LIMIT $2", after_id, PAGE_SIZE
+        )
+    if not rows and after_id:
+        # Последнюю страницу опустошили — показываем список с начала
+        return await shopping_page()
+    if not rows:
+        return "🛒 Список покупок пуст. Добавить: <code>/buy молоко</code>", None
+
+    text = "🛒 <b>Список покупок</b>\n\n" + "\n".join(f"• {html.escape(row['item'])}" for row in rows)
+    buttons = [
+        [InlineKeyboardButton(text=f"✅ {row['item'][:30]}", callback_data=f"shop_del:{row['id']}:{after_id}")]
+        for row in rows
+    ]
+    nav = []
+    if after_id:
+        nav.append(InlineKeyboardButton(text="⏮ В начало", callback_data="shop_page:0"))
+    if len(rows) == PAGE_SIZE:
+        nav.append(InlineKeyboardButton(text="Дальше ▶", callback_data=f"shop_page:{rows[-1]['id']}"))
+    if nav:
+        buttons.append(nav)
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@base_router.message(Command("buy"))
+async def cmd_buy(message: Message):
+    item = message.text.replace("/buy", "", 1).strip()
+    if not item:
+        return await message.answer("🛒 Что купить? Пример: <code>/buy молоко</code>")
+    if len(item) > MAX_ITEM_LENGTH:
+        return await message.answer("⚠️ Слишком длинная запись.")
+
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        await conn.execute("INSERT INTO shopping_list (item) VALUES ($1)", item)
+    await message.answer(f"🛒 Добавлено: <b>{html.escape(item)}</b>")
+
+@base_router.message(Command("list"))
+async def cmd_list(message: Message):
+    text, kb = await shopping_page()
+    await message.answer(text, reply_markup=kb)
+
+@base_router.callback_query(F.data.startswith("shop_page:"))
+async def shop_page(call: CallbackQuery):
+    text, kb = await shopping_page(int(call.data.split(":")[1]))
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer()
+
+@base_router.callback_query(F.data.startswith("shop_del:"))
+async def shop_remove(call: CallbackQuery):
+    _, item_id, after_id = call.data.split(":")
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        removed = await conn.fetchval("DELETE FROM shopping_list WHERE id = $1 RETURNING item", int(item_id))
+
+    text, kb = await shopping_page(int(after_id))
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await call.answer(f"✅ Куплено: {removed}" if removed else "Уже вычеркнуто")
+
 @base_router.message(Command("start"))
 async def start(message: Message):
+    broadcast.subscribe(message.chat.id, broadcast.FAMILY)
     await message.answer(
         "🏠 <b>Домовой на связи!</b>\n\n"
         "🎨 <b>Рисование:</b>\n"
@@ -205,12 +393,14 @@ async def start(message: Message):
         "• /style [текст] — (ответ на фото) изменить стиль\n"
         "• /nobg — (ответ на фото) удалить фон\n\n"
         "🏆 <b>Другое:</b>\n"
-        "• Отправь '+' в ответ на сообщение — поднять репутацию"
+        "• Отправь '+' в ответ на сообщение — поднять репутацию\n"
+        "• /top — рейтинг, /rep — твоя репутация\n"
+        "• /buy [что] — добавить в список покупок, /list — список"
     )
 
 async def send_motivation_to_chat(bot: Bot, chat_id: int):
-    """Функция для планировщика задач"""
+    """Мотивация в один чат; ежедневная рассылка идет через broadcast.daily"""
     try:
-        await bot.send_message(chat_id, "☀️ <b>Доброе утро, семья!</b>\nПусть день будет продуктивным!")
+        await bot.send_message(chat_id, broadcast.MOTIVATION_TEXT, parse_mode="HTML")
     except Exception as e:
         logging.error(f"Motivation error: {e}")
@@ -0,0 +1,33 @@
+import time
+
+from aiogram import BaseMiddleware
+
+from app.services import metrics
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время и ошибки хэндлеров: по имени хэндлера и по состоянию FSM.
+
+    Вешается как inner-middleware: только там известен выбранный хэндлер.
+    """
+
+    async def __call__(self, handler, event, data):
+        # Middleware родительского роутера уже замеряет этот апдейт
+        if data.get("metrics_timed"):
+            return await handler(event, data)
+        data["metrics_timed"] = True
+
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        state = data.get("raw_state")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("handler_errors", labels={"handler": name, "error": type(e).__name__})
+            raise
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            metrics.observe("handler", ms, {"handler": name})
+            if state:
+                metrics.observe("fsm_state", ms, {"state": state})
@@ -0,0 +1,24 @@
+import math
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+
+from app.services import rate_limit
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Ограничивает дорогие команды; имя лимита берется из флага хэндлера rate_limit"""
+
+    async def __call__(self, handler, event, data):
+        name = get_flag(data, "rate_limit")
+        user = data.get("event_from_user")
+        if not name or user is None:
+            return await handler(event, data)
+
+        chat = data.get("event_chat")
+        wait = await rate_limit.consume(name, user.id, chat.id if chat else None)
+        if wait is None:
+            return await handler(event, data)
+
+        # У Message и CallbackQuery одинаковый answer(): сообщение или всплывающая подсказка
+        await event.answer(f"⏳ Подожди {math.ceil(wait)} сек.")
@@ -1,18 +1,18 @@
 import os
-import io
 import logging
 import random
 import urllib.parse
 import aiohttp
-import socket
-import ssl
-from huggingface_hub import AsyncInferenceClient
-from PIL import Image
+
+from app.services import image_cache, image_pipeline, metrics, providers, singleflight
+from app.services.http import get_session, timeout_for
 
 logging.basicConfig(level=logging.INFO)
 
 HF_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
-client = AsyncInferenceClient(token=HF_TOKEN)
+# Адреса провайдеров; подменяются на локальные заглушки в bench/load_test.py
+HF_ROUTER_URL = os.getenv("HF_ROUTER_URL", "https://router.huggingface.co")
+POLLINATIONS_URL = os.getenv("POLLINATIONS_URL", "https://image.pollinations.ai")
 
 # Модели
 GEN_MODEL = "black-forest-labs/FLUX.1-dev"
@@ -21,32 +21,72 @@ REMOVE_BG_MODEL = "briaai/RMBG-1.4"
 GFPGAN_MODEL = "TencentARC/GFPGAN"
 ESRGAN_MODEL = "nightmareai/real-esrgan"
 
-ssl_context = ssl.create_default_context()
-ssl_context.check_hostname = False
-ssl_context.verify_mode = ssl.CERT_NONE
+# Длинная сторона входного фото для каждой модели: больше модели не нужно,
+# а лишние пиксели только удлиняют загрузку и инференс
+MODEL_INPUT_SIZE = {
+    IMG2IMG_MODEL: 512,
+    REMOVE_BG_MODEL: 1024,
+    GFPGAN_MODEL: 1024,
+    ESRGAN_MODEL: 1024,
+}
+
+def pick_input_photo(photos, model: str):
+    """Подходящий по размеру вариант фото из Telegram для модели"""
+    return image_pipeline.pick_photo(photos, MODEL_INPUT_SIZE.get(model))
+
+# ====== КЛЮЧИ КЭША ======
+
+def gen_key(prompt: str) -> str:
+    return image_cache.make_key("text-to-image", GEN_MODEL, prompt)
+
+def img2img_key(image_bytes: bytes, prompt: str) -> str:
+    return image_cache.make_key("image-to-image", IMG2IMG_MODEL, prompt, image_bytes)
 
-async def get_session():
-    connector = aiohttp.TCPConnector(family=socket.AF_INET, ssl=ssl_context)
-    return aiohttp.ClientSession(connector=connector)
+def remove_bg_key(image_bytes: bytes) -> str:
+    return image_cache.make_key("image-segmentation", REMOVE_BG_MODEL, None, image_bytes)
+
+def process_key(image_bytes: bytes, model: str) -> str:
+    return image_cache.make_key("image-to-image", model, "masterpiece, high quality", image_bytes)
+
+async def _finalized(produce):
+    return await image_pipeline.finalize(await produce())
+
+async def _cached_call(key: str, produce):
+    # Готовый результат берем из кэша, одинаковые одновременные задачи делят один запрос
+    return await singleflight.do(key, lambda: image_cache.cached(key, lambda: _finalized(produce)))
 
 # ====== ГЕНЕРАЦИЯ (FLUX) - Оставляем как есть, она работает ======
 async def generate_best(prompt: str):
-    try:
-        output_image = await client.text_to_image(prompt=prompt, model=GEN_MODEL)
-        img_byte_arr = io.BytesIO()
-        output_image.save(img_byte_arr, format='PNG')
-        return img_byte_arr.getvalue()
-    except Exception as e:
-        logging.warning(f"⚠️ FLUX failed, using Pollinations")
-        seed = random.randint(1, 999999)
-        encoded = urllib.parse.quote(prompt)
-        url = f"https://image.pollinations.ai/prompt/{encoded}?width=1024&height=1024&seed={seed}&nologo=true"
-        async with await get_session() as session:
-            try:
-                async with session.get(url, timeout=30) as r:
-                    if r.status == 200: return await r.read()
-            except: pass
-        return None
+    # Одинаковый промпт не отправляем на генерацию повторно
+    return await _cached_call(gen_key(prompt), lambda: _generate(prompt))
+
+async def _generate(prompt: str):
+    # Роутер сам выбирает самый быстрый из здоровых бэкендов
+    return await providers.route(GEN_PROVIDERS, prompt)
+
+async def _flux(prompt: str):
+    # Берем байты как их отдал провайдер: без декодирования в PIL и пересжатия в PNG
+    if not HF_TOKEN: raise RuntimeError("HUGGINGFACE_TOKEN не задан")
+    url = f"{HF_ROUTER_URL}/hf-inference/models/{GEN_MODEL}"
+    headers = {"Authorization": f"Bearer {HF_TOKEN}", "Accept": "image/*"}
+    session = await get_session()
+    async with session.post(url, headers=headers, json={"inputs": prompt}, timeout=timeout_for("text-to-image")) as r:
+        if r.status == 200: return await r.read()
+        raise RuntimeError(f"FLUX {r.status}: {(await r.text())[:100]}")
+
+async def _pollinations(prompt: str):
+    seed = random.randint(1, 999999)
+    encoded = urllib.parse.quote(prompt)
+    url = f"{POLLINATIONS_URL}/prompt/{encoded}?width=1024&height=1024&seed={seed}&nologo=true"
+    session = await get_session()
+    async with session.get(url, timeout=timeout_for("pollinations")) as r:
+        if r.status == 200: return await r.read()
+        raise RuntimeError(f"Pollinations {r.status}")
+
+GEN_PROVIDERS = [
+    providers.register("flux", _flux),
+    providers.register("pollinations", _pollinations),
+]
 
 # ====== НОВЫЙ МЕТОД ОБРАБОТКИ ЧЕРЕЗ TASK-BASED ROUTER ======
 
@@ -55,9 +95,10 @@ async def hf_task_query(image_bytes: bytes, task: str, model: str, prompt: str =
     if not HF_TOKEN: return None
     
     # Новый формат URL: /v1/{task}
-    url = f"https://router.huggingface.co/hf-inference/v1/{task}"
+    url = f"{HF_ROUTER_URL}/hf-inference/v1/{task}"
     
     headers = {"Authorization": f"Bearer {HF_TOKEN}"}
+    image_bytes = await image_pipeline.fit(image_bytes, MODEL_INPUT_SIZE.get(model))
     
     # Упаковываем в FormData, так как новый роутер /v1/ ждет именно этот формат
     data = aiohttp.FormData()
@@ -66,30 +107,43 @@ async def hf_task_query(image_bytes: bytes, task: str, model: str, prompt: str =
     if prompt:
         data.add_field('prompt', prompt)
 
-    async with await get_session() as session:
-        try:
-            async with session.post(url, headers=headers, data=data, timeout=60) as r:
+    session = await get_session()
+    labels = {"task": task, "model": model.rsplit("/", 1)[-1]}
+    try:
+        with metrics.timer("inference", labels):
+            async with session.post(url, headers=headers, data=data, timeout=timeout_for(task)) as r:
                 if r.status == 200:
                     return await r.read()
                 
                 err_text = await r.text()
-                logging.error(f"❌ Task Error ({task}): {r.status} - {err_text[:100]}")
-                return None
-        except Exception as e:
-            logging.error(f"❌ Task Exception: {e}")
-            return None
+        logging.error(f"❌ Task Error ({task}): {r.status} - {err_text[:100]}")
+        metrics.inc("inference_errors", labels=labels)
+        return None
+    except Exception as e:
+        logging.error(f"❌ Task Exception: {e}")
+        metrics.inc("inference_errors", labels=labels)
+        return None
 
 # ====== ПУБЛИЧНЫЕ ФУНКЦИИ ======
 
 async def hf_img2img(image_bytes: bytes, prompt: str):
     # Задача для стилизации - image-to-image
-    return await hf_task_query(image_bytes, "image-to-image", IMG2IMG_MODEL, prompt)
+    return await _cached_call(
+        img2img_key(image_bytes, prompt),
+        lambda: hf_task_query(image_bytes, "image-to-image", IMG2IMG_MODEL, prompt)
+    )
 
 async def hf_remove_bg(image_bytes: bytes):
     # Задача для удаления фона - image-segmentation
-    return await hf_task_query(image_bytes, "image-segmentation", REMOVE_BG_MODEL)
+    return await _cached_call(
+        remove_bg_key(image_bytes),
+        lambda: hf_task_query(image_bytes, "image-segmentation", REMOVE_BG_MODEL)
+    )
 
 async def hf_image_process(image_bytes: bytes, model: str):
     # Апскейл и лица тоже идут через image-to-image
-    return await hf_task_query(image_bytes, "image-to-image", model, "masterpiece, high quality")
+    return await _cached_call(
+        process_key(image_bytes, model),
+        lambda: hf_task_query(image_bytes, "image-to-image", model, "masterpiece, high quality")
+    )
     
@@ -0,0 +1,322 @@
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from zoneinfo import ZoneInfo
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from app.services import metrics
+
+# Рассылки по подписанным чатам. Прогресс каждой доставки пишется в SQLite,
+# поэтому после перезапуска рассылка продолжается с того же места
+BROADCAST_PATH = os.getenv("BROADCAST_PATH", "data/broadcast.sqlite3")
+# Telegram пропускает около 30 сообщений в секунду на бота; оставляем запас
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+# В один чат: личка — раз в секунду, группа — 20 сообщений в минуту
+PRIVATE_INTERVAL = 1.0
+GROUP_INTERVAL = 3.0
+MAX_ATTEMPTS = 3
+PAGE = 500
+TICK = 5
+# Ежедневная задача, пропущенная из-за простоя, догоняется не позже чем через это время
+DAILY_GRACE = datetime.timedelta(hours=2)
+BOT_TZ = ZoneInfo(os.getenv("BOT_TZ", "Asia/Yekaterinburg"))
+
+# Утренняя мотивация во все чаты аудитории family — где запускали /start (время — BOT_TZ)
+FAMILY = "family"
+MOTIVATION_TEXT = "☀️ <b>Доброе утро, семья!</b>\nПусть день будет продуктивным!"
+MOTIVATION_TIME = os.getenv("MOTIVATION_TIME", "08:00")
+
+_conn = None
+_task = None
+_wakeup = None
+_daily = {}
+_chat_ready = {}
+
+
+class _Limiter:
+    """Общий темп отправки: после RetryAfter пауза и вдвое медленнее, потом плавный разгон"""
+
+    def __init__(self, rate: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.next_at = 0.0
+        self.streak = 0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + 1 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def flood(self, retry_after: float):
+        self.rate = max(1.0, self.rate / 2)
+        self.next_at = max(self.next_at, time.monotonic() + retry_after)
+        self.streak = 0
+        metrics.inc("broadcast_flood_wait")
+
+    def success(self):
+        self.streak += 1
+        if self.streak >= 50 and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 1)
+            self.streak = 0
+
+
+_limiter = _Limiter(BROADCAST_RATE)
+
+
+def init_broadcast(path: str = BROADCAST_PATH):
+    global _conn
+    if _conn is not None:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    _conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.executescript("""
+    CREATE TABLE IF NOT EXISTS chats (
+        chat_id INTEGER NOT NULL,
+        audience TEXT NOT NULL,
+        subscribed_at REAL NOT NULL,
+        blocked_at REAL,
+        PRIMARY KEY (chat_id, audience)
+    );
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        audience TEXT NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        run_at REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'scheduled',
+        notify_chat INTEGER,
+        created_at REAL NOT NULL,
+        done_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS deliveries (
+        broadcast_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        PRIMARY KEY (broadcast_id, chat_id)
+    );
+    CREATE TABLE IF NOT EXISTS daily_runs (
+        name TEXT PRIMARY KEY,
+        last_date TEXT NOT NULL
+    );
+    """)
+    metrics.register("broadcast", stats, labels={"running": "status"})
+
+
+def subscribe(chat_id: int, audience: str):
+    """Добавляет чат в аудиторию; если он раньше блокировал бота — снова активен"""
+    init_broadcast()
+    _conn.execute(
+        "INSERT INTO chats (chat_id, audience, subscribed_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (chat_id, audience) DO UPDATE SET blocked_at = NULL",
+        (chat_id, audience, time.time())
+    )
+
+
+def create(audience: str, text: str, run_at: float = None, parse_mode: str = None, notify_chat: int = None) -> int:
+    """Ставит рассылку; run_at — unix-время запуска (по умолчанию сразу)"""
+    init_broadcast()
+    cursor = _conn.execute(
+        "INSERT INTO broadcasts (audience, text, parse_mode, run_at, notify_chat, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (audience, text, parse_mode, run_at or time.time(), notify_chat, time.time())
+    )
+    if _wakeup is not None:
+        _wakeup.set()
+    return cursor.lastrowid
+
+
+def daily(name: str, at: str, audience: str, text: str, parse_mode: str = None):
+    """Ежедневная рассылка в at ("ЧЧ:ММ", часовой пояс BOT_TZ)"""
+    _daily[name] = (datetime.time.fromisoformat(at), audience, text, parse_mode)
+
+
+def schedule_motivation():
+    """Ставит ежедневную утреннюю мотивацию; повторный вызов ничего не меняет"""
+    daily("morning_motivation", MOTIVATION_TIME, FAMILY, MOTIVATION_TEXT, parse_mode="HTML")
+
+
+def _counts(broadcast_id: int) -> dict:
+    rows = _conn.execute(
+        "SELECT status, COUNT(*) FROM deliveries WHERE broadcast_id = ? GROUP BY status", (broadcast_id,)
+    ).fetchall()
+    return dict(rows)
+
+
+def stats() -> dict:
+    running = _conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1").fetchone()
+    scheduled = _conn.execute("SELECT COUNT(*) FROM broadcasts WHERE status = 'scheduled'").fetchone()[0]
+    return {
+        "scheduled": scheduled,
+        "running": _counts(running[0]) if running else {},
+        "rate": round(_limiter.rate, 1),
+    }
+
+
+def _finish(broadcast_id: int, chat_id: int, status: str, error: str = None):
+    _conn.execute(
+        "UPDATE deliveries SET status = ?, attempts = attempts + 1, error = ? WHERE broadcast_id = ? AND chat_id = ?",
+        (status, error, broadcast_id, chat_id)
+    )
+
+
+def _gone(e: Exception) -> bool:
+    """Чат больше недоступен: бот заблокирован, исключен из группы или чат удален"""
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    return isinstance(e, TelegramBadRequest) and "chat not found" in str(e).lower()
+
+
+async def _send(bot, broadcast, chat_id: int):
+    broadcast_id, _, text, parse_mode = broadcast
+    while True:
+        ready = _chat_ready.get(chat_id, 0) - time.monotonic()
+        if ready > 0:
+            await asyncio.sleep(ready)
+        await _limiter.acquire()
+        _chat_ready[chat_id] = time.monotonic() + (GROUP_INTERVAL if chat_id < 0 else PRIVATE_INTERVAL)
+        try:
+            await bot.send_message(chat_id, text, parse_mode=parse_mode)
+        except TelegramRetryAfter as e:
+            _limiter.flood(e.retry_after)
+            continue
+        except Exception as e:
+            if not _gone(e):
+                attempts = _conn.execute(
+                    "SELECT attempts FROM deliveries WHERE broadcast_id = ? AND chat_id = ?", (broadcast_id, chat_id)
+                ).fetchone()[0]
+                # Не последняя попытка — остается pending и уйдет на следующем проходе
+                _finish(broadcast_id, chat_id, "failed" if attempts + 1 >= MAX_ATTEMPTS else "pending", str(e)[:200])
+                metrics.inc("broadcast_errors")
+                return
+            # Больше сюда не пишем ни в этой, ни в следующих рассылках
+            _finish(broadcast_id, chat_id, "blocked", str(e)[:200])
+            _conn.execute("UPDATE chats SET blocked_at = ? WHERE chat_id = ?", (time.time(), chat_id))
+            metrics.inc("broadcast_blocked")
+            return
+        _limiter.success()
+        _finish(broadcast_id, chat_id, "sent")
+        metrics.inc("broadcast_sent")
+        return
+
+
+async def _deliver(bot, broadcast):
+    broadcast_id, audience = broadcast[0], broadcast[1]
+    # Получатели фиксируются при запуске; при возобновлении добавятся только новые подписчики
+    _conn.execute(
+        "INSERT OR IGNORE INTO deliveries (broadcast_id, chat_id) "
+        "SELECT ?, chat_id FROM chats WHERE audience = ? AND blocked_at IS NULL",
+        (broadcast_id, audience)
+    )
+    _conn.execute("UPDATE broadcasts SET status = 'running' WHERE id = ?", (broadcast_id,))
+    slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(chat_id):
+        async with slots:
+            await _send(bot, broadcast, chat_id)
+
+    with metrics.timer("broadcast"):
+        while True:
+            rows = _conn.execute(
+                "SELECT chat_id, attempts FROM deliveries WHERE broadcast_id = ? AND status = 'pending' "
+                "ORDER BY attempts, chat_id LIMIT ?",
+                (broadcast_id, PAGE)
+            ).fetchall()
+            if not rows:
+                break
+            if rows[0][1]:
+                # Остались только повторы после ошибок — не долбим сразу же
+                await asyncio.sleep(TICK)
+            await asyncio.gather(*(send(chat_id) for chat_id, _ in rows))
+
+    now = time.monotonic()
+    for chat_id in [c for c, ready in _chat_ready.items() if ready < now]:
+        del _chat_ready[chat_id]
+
+    _conn.execute("UPDATE broadcasts SET status = 'done', done_at = ? WHERE id = ?", (time.time(), broadcast_id))
+    return _counts(broadcast_id)
+
+
+def _due_daily(now: datetime.datetime):
+    today = now.date().isoformat()
+    for name, (at, audience, text, parse_mode) in _daily.items():
+        planned = datetime.datetime.combine(now.date(), at, tzinfo=BOT_TZ)
+        if not planned <= now < planned + DAILY_GRACE:
+            continue
+        row = _conn.execute("SELECT last_date FROM daily_runs WHERE name = ?", (name,)).fetchone()
+        if row and row[0] == today:
+            continue
+        _conn.execute(
+            "INSERT INTO daily_runs (name, last_date) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET last_date = excluded.last_date",
+            (name, today)
+        )
+        create(audience, text, parse_mode=parse_mode)
+        logging.info(f"Рассылка {name} поставлена на {today}")
+
+
+async def _run(bot):
+    while True:
+        _due_daily(datetime.datetime.now(BOT_TZ))
+        broadcast = _conn.execute(
+            "SELECT id, audience, text, parse_mode, notify_chat FROM broadcasts "
+            "WHERE status IN ('scheduled', 'running') AND run_at <= ? "
+            "ORDER BY status = 'running' DESC, run_at LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+        if broadcast is not None:
+            try:
+                counts = await _deliver(bot, broadcast[:4])
+            except Exception as e:
+                logging.error(f"Рассылка {broadcast[0]} прервана: {e}")
+                await asyncio.sleep(TICK)
+                continue
+            logging.info(f"Рассылка {broadcast[0]} завершена: {counts}")
+            if broadcast[4]:
+                try:
+                    await bot.send_message(
+                        broadcast[4],
+                        f"📣 Рассылка #{broadcast[0]} завершена: доставлено {counts.get('sent', 0)}, "
+                        f"ошибок {counts.get('failed', 0)}, заблокировали бота {counts.get('blocked', 0)}"
+                    )
+                except Exception as e:
+                    logging.error(f"Отчет о рассылке не отправлен: {e}")
+            continue
+
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), TICK)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start(bot):
+    """Запускает рассыльщик и планировщик; незавершенные рассылки продолжаются"""
+    global _task, _wakeup
+    init_broadcast()
+    if _task is not None:
+        return
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run(bot))
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
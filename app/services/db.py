@@ -1,20 +1,135 @@
+import asyncio
 import asyncpg
 import os
 import logging
+import time
+
+from app.services import metrics, migrations
+from config import settings
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 pool = None
+_waiting = 0
+_init_lock = asyncio.Lock()
+_connector = None
+MAX_RETRY_DELAY = 60
+
+
+class _Acquire:
+    """pool.acquire() с подсчетом ожидающих и временем получения соединения"""
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        global _waiting
+        _waiting += 1
+        started = time.perf_counter()
+        try:
+            self.conn = await self.pool.acquire(timeout=self.timeout)
+        finally:
+            _waiting -= 1
+            metrics.observe("db_acquire", (time.perf_counter() - started) * 1000)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        await self.pool.release(self.conn)
+
+    def __await__(self):
+        return self.__aenter__().__await__()
+
+
+class MeteredPool:
+    """Обертка пула asyncpg: acquire() измеряется, остальное — как у пула"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def acquire(self, *, timeout=None):
+        return _Acquire(self._pool, timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+def pool_stats() -> dict:
+    if pool is None:
+        return {}
+    size = pool.get_size()
+    return {
+        "size": size,
+        "max": pool.get_max_size(),
+        "in_use": size - pool.get_idle_size(),
+        "waiting": _waiting,
+    }
+
 
 async def init_pool():
+    """Создает пул и доводит схему до последней миграции"""
     global pool
-    if pool is None:
+    async with _init_lock:
+        if pool is not None:
+            return
+        raw = None
+        config = settings.config
         try:
-            pool = await asyncpg.create_pool(DATABASE_URL)
+            raw = await asyncpg.create_pool(
+                DATABASE_URL,
+                min_size=config.db_pool_min_size,
+                max_size=config.db_pool_max_size,
+                max_inactive_connection_lifetime=config.db_max_inactive_lifetime,
+                statement_cache_size=config.db_statement_cache_size,
+                command_timeout=config.db_command_timeout,
+                timeout=config.db_connect_timeout,
+            )
+            await migrations.run(raw)
+            pool = MeteredPool(raw)
+            metrics.register("db_pool", pool_stats)
             logging.info("DB Pool initialized successfully")
+        except asyncio.CancelledError:
+            # Отмена посреди подключения или миграций: закрываем соединения без await
+            if raw is not None:
+                raw.terminate()
+            raise
         except Exception as e:
             logging.error(f"Failed to create DB pool: {e}")
+            if raw is not None:
+                await raw.close()
             raise
 
+async def _connect():
+    delay = 1
+    while pool is None:
+        try:
+            await init_pool()
+        except Exception:
+            metrics.inc("db_connect_retry")
+            logging.warning(f"DB: повтор подключения через {delay} сек.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+def start_connecting():
+    """Поднимает пул в фоне с повторами — старт бота не ждет базу"""
+    global _connector
+    if pool is None and (_connector is None or _connector.done()):
+        _connector = asyncio.create_task(_connect())
+
+
+async def stop_connecting():
+    global _connector
+    if _connector is None:
+        return
+    _connector.cancel()
+    try:
+        await _connector
+    except asyncio.CancelledError:
+        pass
+    _connector = None
+
+
 async def get_db():
     if pool is None:
         await init_pool()
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from app.services import metrics
+
+# FSM_STORAGE: sqlite (по умолчанию) | postgres | memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "data/fsm.sqlite3")
+# Брошенные анкеты удаляются через сутки без активности
+FSM_TTL = int(os.getenv("FSM_TTL", 24 * 3600))
+# Кэш на чтение и отложенная запись годятся только для одного процесса. С postgres
+# следующий апдейт может попасть на другой инстанс, поэтому по умолчанию состояние
+# читается из базы каждый раз и записывается до возврата из хэндлера
+_SHARED = FSM_STORAGE == "postgres"
+# Сколько секунд доверяем локальному кэшу
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 0 if _SHARED else 30))
+# 0 — запись сразу при set_state/set_data
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0 if _SHARED else 0.2))
+
+
+class SqliteBackend:
+    """Состояния в локальном файле SQLite"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """)
+
+    async def load(self, key):
+        return self.conn.execute("SELECT state, data FROM fsm_state WHERE key = ?", (key,)).fetchone()
+
+    async def save(self, rows):
+        # Весь пакет — одна транзакция
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                rows
+            )
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    async def delete(self, keys):
+        self.conn.executemany("DELETE FROM fsm_state WHERE key = ?", [(k,) for k in keys])
+
+    async def expire(self, before):
+        return self.conn.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,)).rowcount
+
+    async def close(self):
+        self.conn.close()
+
+
+class PostgresBackend:
+    """Состояния в общей базе — можно запускать несколько воркеров.
+    Таблицу fsm_state создает миграция при подключении к базе"""
+
+    async def _pool(self):
+        from app.services.db import get_db
+        return await get_db()
+
+    async def load(self, key):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT state, data FROM fsm_state WHERE key = $1", key)
+        return (row["state"], row["data"]) if row else None
+
+    async def save(self, rows):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO fsm_state (key, state, data, updated_at) VALUES ($1, $2, $3, $4) "
+                "ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, "
+                "updated_at = EXCLUDED.updated_at",
+                rows
+            )
+
+    async def delete(self, keys):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM fsm_state WHERE key = ANY($1::text[])", keys)
+
+    async def expire(self, before):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            result = await conn.execute("DELETE FROM fsm_state WHERE updated_at < $1", before)
+        return int(result.split()[-1])
+
+    async def close(self):
+        pass
+
+
+class SQLStorage(BaseStorage):
+    """FSM-хранилище с кэшем на чтение и пакетной записью изменений"""
+
+    def __init__(self, backend, ttl: int = FSM_TTL, cache_ttl: float = FSM_CACHE_TTL,
+                 flush_interval: float = FSM_FLUSH_INTERVAL):
+        self.backend = backend
+        self.ttl = ttl
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        # key -> [state, data, loaded_at]
+        self._cache = {}
+        self._dirty = set()
+        self._task = None
+        metrics.register("fsm_storage", lambda: {"cached": len(self._cache), "dirty": len(self._dirty)})
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey):
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is not None and (k in self._dirty or time.monotonic() - entry[2] < self.cache_ttl):
+            metrics.inc("fsm_cache_hit")
+            return k, entry
+
+        metrics.inc("fsm_cache_miss")
+        row = await self.backend.load(k)
+        entry = [row[0], json.loads(row[1]), time.monotonic()] if row else [None, {}, time.monotonic()]
+        self._cache[k] = entry
+        return k, entry
+
+    async def _touch(self, k: str):
+        self._dirty.add(k)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        if self.flush_interval <= 0:
+            await self.flush()
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        k, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._touch(k)
+
+    async def get_state(self, key: StorageKey):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        k, entry = await self._entry(key)
+        entry[1] = data.copy()
+        await self._touch(k)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def flush(self):
+        """Записывает накопленные изменения одним пакетом"""
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+        rows, deleted = [], []
+        for k in keys:
+            state, data, _ = self._cache[k]
+            if state is None and not data:
+                deleted.append(k)
+            else:
+                rows.append((k, state, json.dumps(data, ensure_ascii=False), now))
+        try:
+            with metrics.timer("fsm_flush"):
+                if rows:
+                    await self.backend.save(rows)
+                if deleted:
+                    await self.backend.delete(deleted)
+        except Exception as e:
+            logging.error(f"Ошибка записи FSM ({len(keys)} ключей): {e}")
+            self._dirty |= keys
+
+    async def sweep(self):
+        """Удаляет брошенные анкеты и устаревшие записи кэша"""
+        expired = await self.backend.expire(time.time() - self.ttl)
+        if expired:
+            metrics.inc("fsm_expired", expired)
+        limit = time.monotonic() - max(self.cache_ttl, 1)
+        for k in [k for k, e in self._cache.items() if e[2] < limit and k not in self._dirty]:
+            del self._cache[k]
+
+    async def _run(self):
+        last_sweep = time.monotonic()
+        while True:
+            # При записи сразу цикл только повторяет неудавшиеся записи и чистит старое
+            await asyncio.sleep(self.flush_interval or 1)
+            await self.flush()
+            if time.monotonic() - last_sweep > 60:
+                last_sweep = time.monotonic()
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logging.error(f"Ошибка очистки FSM: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.backend.close()
+
+
+def create_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE"""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "postgres":
+        return SQLStorage(PostgresBackend())
+    return SQLStorage(SqliteBackend(FSM_SQLITE_PATH))
@@ -0,0 +1,178 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from app.services import metrics
+
+# gspread, google-auth и googleapiclient импортируются внутри функций: вместе это
+# заметная доля холодного старта, а нужны они только при первой заявке (см. warm_up)
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+# Resumable-загрузка читает файл кусками; Drive требует размер, кратный 256 КБ
+UPLOAD_CHUNK = 4 * 256 * 1024
+
+# Отдельный пул для Google, чтобы не занимать общий executor asyncio.to_thread
+GOOGLE_WORKERS = int(os.getenv("GOOGLE_WORKERS", 4))
+GOOGLE_QUEUE_MAX = int(os.getenv("GOOGLE_QUEUE_MAX", 32))
+_executor = ThreadPoolExecutor(max_workers=GOOGLE_WORKERS, thread_name_prefix="google")
+_slots = None
+_admitted = 0
+_waiting = 0
+
+# Ключ разбирается один раз, клиенты живут всё время работы процесса
+_creds = None
+_gspread_client = None
+_worksheets = {}
+_lock = threading.Lock()
+# googleapiclient (httplib2) не потокобезопасен — свой Drive-клиент на каждый поток
+_local = threading.local()
+
+
+def init_google():
+    """Разбирает GOOGLE_JSON_KEY и создает общие учетные данные (один раз)"""
+    global _creds, _gspread_client
+    with _lock:
+        if _creds is not None:
+            return _creds
+
+        started = time.perf_counter()
+        import gspread
+        from google.oauth2 import service_account
+
+        encoded_key = os.getenv("GOOGLE_JSON_KEY", "").strip()
+        decoded_key = base64.b64decode(encoded_key).decode('utf-8')
+        key_data = json.loads(decoded_key)
+
+        if "private_key" in key_data:
+            key_data["private_key"] = key_data["private_key"].replace("\\n", "\n")
+
+        _creds = service_account.Credentials.from_service_account_info(key_data, scopes=SCOPES)
+        _gspread_client = gspread.authorize(_creds)
+        metrics.observe("google_init", (time.perf_counter() - started) * 1000)
+        logging.info("Google credentials initialized")
+        return _creds
+
+
+def _fresh_creds():
+    """Возвращает учетные данные, обновляя токен под блокировкой, если он истек"""
+    creds = _creds or init_google()
+    if not creds.valid:
+        from google.auth.transport.requests import Request
+        with _lock:
+            if not creds.valid:
+                creds.refresh(Request())
+                metrics.inc("google_token_refresh")
+    return creds
+
+
+def get_drive():
+    """Drive-клиент текущего потока"""
+    creds = _fresh_creds()
+    drive = getattr(_local, "drive", None)
+    if drive is None:
+        from googleapiclient.discovery import build
+        drive = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        _local.drive = drive
+    return drive
+
+
+def get_worksheet(sheet_id: str):
+    """Первый лист таблицы; handle кэшируется между вызовами"""
+    _fresh_creds()
+    sheet = _worksheets.get(sheet_id)
+    if sheet is None:
+        with _lock:
+            sheet = _worksheets.get(sheet_id)
+            if sheet is None:
+                sheet = _gspread_client.open_by_key(sheet_id).sheet1
+                _worksheets[sheet_id] = sheet
+    return sheet
+
+
+def find_file(folder_id: str, prop: str, value: str):
+    """Ищет в папке файл с заданным appProperties (для идемпотентной загрузки)"""
+    query = f"'{folder_id}' in parents and appProperties has {{ key='{prop}' and value='{value}' }} and trashed = false"
+    files = get_drive().files().list(q=query, fields='files(id, webViewLink)', pageSize=1).execute().get('files', [])
+    return files[0] if files else None
+
+
+def find_row(sheet_id: str, column: int, value: str) -> bool:
+    """Есть ли в столбце column (с 1) строка с таким значением (для идемпотентной записи)"""
+    return get_worksheet(sheet_id).find(value, in_column=column) is not None
+
+
+def upload_file(stream, name: str, folder_id: str, mimetype: str = 'image/jpeg', properties: dict = None) -> dict:
+    """Загружает файловый объект в папку Drive кусками по UPLOAD_CHUNK, возвращает id и webViewLink"""
+    from googleapiclient.http import MediaIoBaseUpload
+    file_metadata = {'name': name, 'parents': [folder_id]}
+    if properties:
+        file_metadata['appProperties'] = properties
+    media = MediaIoBaseUpload(stream, mimetype=mimetype, chunksize=UPLOAD_CHUNK, resumable=True)
+    return get_drive().files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
+
+
+async def run(fn, *args):
+    """Выполняет блокирующий вызов в пуле Google; при переполненной очереди ждет места"""
+    global _slots, _admitted, _waiting
+    if _slots is None:
+        _slots = asyncio.Semaphore(GOOGLE_WORKERS + GOOGLE_QUEUE_MAX)
+    _waiting += 1
+    try:
+        await _slots.acquire()
+    finally:
+        _waiting -= 1
+    _admitted += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _admitted -= 1
+        _slots.release()
+
+
+def _warm():
+    init_google()
+    import googleapiclient.discovery  # noqa: F401
+    import googleapiclient.http  # noqa: F401
+
+
+async def warm_up():
+    """Импорт клиентов и разбор ключа в пуле Google — запускается после старта бота,
+    чтобы не задерживать первый апдейт"""
+    started = time.perf_counter()
+    try:
+        await run(_warm)
+    except Exception as e:
+        logging.error(f"Ошибка инициализации Google: {e}")
+        return
+    metrics.observe("google_warm_up", (time.perf_counter() - started) * 1000)
+    metrics.startup_phase("google_ready")
+
+
+def pool_stats() -> dict:
+    """Загрузка пула Google для /stats"""
+    return {
+        "workers": GOOGLE_WORKERS,
+        "in_flight": _admitted,
+        "queued": max(0, _admitted - GOOGLE_WORKERS),
+        "waiting": _waiting,
+    }
+
+
+metrics.register("google_pool", pool_stats)
+
+
+@contextmanager
+def timed(name: str):
+    """Замер вызова с разделением на холодный (клиенты создаются) и теплый"""
+    cold = _creds is None or not _worksheets or getattr(_local, "drive", None) is None
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, (time.perf_counter() - started) * 1000, {"start": "cold" if cold else "warm"})
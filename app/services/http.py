@@ -0,0 +1,56 @@
+import os
+import socket
+import ssl
+
+import aiohttp
+
+# Одна сессия на процесс: соединения с HF и Pollinations переиспользуются
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", 100))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))
+
+# Таймауты по типу задачи: генерация идет дольше, чем сегментация
+TIMEOUTS = {
+    "text-to-image": aiohttp.ClientTimeout(total=90, connect=10),
+    "image-to-image": aiohttp.ClientTimeout(total=60, connect=10),
+    "image-segmentation": aiohttp.ClientTimeout(total=30, connect=10),
+    "pollinations": aiohttp.ClientTimeout(total=30, connect=10),
+}
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+
+ssl_context = ssl.create_default_context()
+ssl_context.check_hostname = False
+ssl_context.verify_mode = ssl.CERT_NONE
+
+_session = None
+
+
+def make_connector() -> aiohttp.TCPConnector:
+    return aiohttp.TCPConnector(
+        family=socket.AF_INET,
+        ssl=ssl_context,
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_TTL,
+    )
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Общая сессия процесса; создается при первом обращении"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=make_connector(), timeout=DEFAULT_TIMEOUT)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def timeout_for(task: str) -> aiohttp.ClientTimeout:
+    return TIMEOUTS.get(task, DEFAULT_TIMEOUT)
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from app.services import metrics
+
+# Кэш результатов генерации: память (LRU) + диск с бюджетом по байтам
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "data/image_cache")
+IMAGE_CACHE_MEMORY = int(os.getenv("IMAGE_CACHE_MEMORY", 64 * 1024 * 1024))
+IMAGE_CACHE_DISK = int(os.getenv("IMAGE_CACHE_DISK", 512 * 1024 * 1024))
+FILE_ID_LIMIT = 10000
+
+_memory = OrderedDict()
+_memory_bytes = 0
+_file_ids = OrderedDict()
+_disk_bytes = None
+_disk_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0}
+
+
+def make_key(task: str, model: str, prompt: str = None, image=None) -> str:
+    """Ключ по содержимому: хэш входной картинки, модели и промпта"""
+    h = hashlib.blake2b(digest_size=20)
+    for part in (task, model, prompt or ""):
+        h.update(part.encode())
+        h.update(b"\0")
+    if image is not None:
+        h.update(image)
+    return h.hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], key)
+
+
+def _remember(key: str, data: bytes):
+    global _memory_bytes
+    if len(data) > IMAGE_CACHE_MEMORY:
+        return
+    old = _memory.pop(key, None)
+    if old is not None:
+        _memory_bytes -= len(old)
+    _memory[key] = data
+    _memory_bytes += len(data)
+    while _memory_bytes > IMAGE_CACHE_MEMORY:
+        _, evicted = _memory.popitem(last=False)
+        _memory_bytes -= len(evicted)
+
+
+def _disk_read(key: str):
+    try:
+        with open(_path(key), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # mtime служит меткой последнего использования для вытеснения
+    os.utime(_path(key))
+    return data
+
+
+def _disk_scan() -> int:
+    total = 0
+    for root, _, files in os.walk(IMAGE_CACHE_DIR):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _disk_evict():
+    global _disk_bytes
+    entries = []
+    for root, _, files in os.walk(IMAGE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    target = IMAGE_CACHE_DISK * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        os.remove(path)
+        total -= size
+    _disk_bytes = total
+
+
+def _disk_write(key: str, data: bytes):
+    global _disk_bytes
+    path = _path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    with _disk_lock:
+        if _disk_bytes is None:
+            _disk_bytes = _disk_scan()
+        os.replace(tmp, path)
+        _disk_bytes += len(data)
+        if _disk_bytes > IMAGE_CACHE_DISK:
+            _disk_evict()
+
+
+async def get(key: str):
+    """Результат из памяти или с диска"""
+    data = _memory.get(key)
+    if data is not None:
+        _memory.move_to_end(key)
+        return data
+    if IMAGE_CACHE_DISK <= 0:
+        return None
+    data = await asyncio.to_thread(_disk_read, key)
+    if data is not None:
+        _remember(key, data)
+    return data
+
+
+async def put(key: str, data: bytes):
+    _remember(key, data)
+    if IMAGE_CACHE_DISK > 0:
+        try:
+            await asyncio.to_thread(_disk_write, key, data)
+        except OSError as e:
+            logging.warning(f"Image cache write failed: {e}")
+
+
+async def cached(key: str, produce):
+    """Возвращает результат из кэша или вызывает produce() и сохраняет ответ"""
+    data = await get(key)
+    if data is not None:
+        _stats["hits"] += 1
+        metrics.inc("image_cache_hit")
+        metrics.inc("image_cache_bytes_saved", len(data))
+        return data
+
+    _stats["misses"] += 1
+    metrics.inc("image_cache_miss")
+    data = await produce()
+    if data:
+        await put(key, data)
+    return data
+
+
+def get_file_id(key: str):
+    """file_id уже отправленного в Telegram результата — можно переслать без загрузки"""
+    file_id = _file_ids.get(key)
+    if file_id is not None:
+        _file_ids.move_to_end(key)
+        metrics.inc("image_cache_file_id_hit")
+    return file_id
+
+
+def remember_file_id(key: str, file_id: str):
+    _file_ids[key] = file_id
+    _file_ids.move_to_end(key)
+    if len(_file_ids) > FILE_ID_LIMIT:
+        _file_ids.popitem(last=False)
+
+
+def forget_file_id(key: str):
+    _file_ids.pop(key, None)
+
+
+def stats() -> dict:
+    total = _stats["hits"] + _stats["misses"]
+    return {
+        "hit_rate": round(_stats["hits"] / total, 3) if total else 0,
+        "memory_entries": len(_memory),
+        "memory_bytes": _memory_bytes,
+        "disk_bytes": _disk_bytes,
+        "file_ids": len(_file_ids),
+    }
+
+
+metrics.register("image_cache", stats)
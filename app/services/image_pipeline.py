@@ -0,0 +1,101 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services import metrics
+
+# IMAGE_FORMAT: пусто — оставляем кодировку провайдера; webp | jpeg | png — перекодируем
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+IMAGE_WORKERS = int(os.getenv("IMAGE_ENCODE_WORKERS", 2))
+
+# Кодирование и ресайз не должны блокировать цикл событий; PIL отпускает GIL
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+EXTENSIONS = {"jpeg": "jpg", "png": "png", "webp": "webp", "gif": "gif"}
+
+
+def sniff_format(data):
+    """Формат по сигнатуре файла, без декодирования"""
+    head = bytes(data[:12])
+    if head.startswith(b"\x89PNG"):
+        return "png"
+    if head.startswith(b"\xff\xd8"):
+        return "jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith(b"GIF8"):
+        return "gif"
+    return None
+
+
+def extension(data) -> str:
+    return EXTENSIONS.get(sniff_format(data), "png")
+
+
+def _encode(data, fmt: str, quality: int) -> bytes:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if fmt == "jpeg":
+            if "A" in image.getbands() or "transparency" in image.info:
+                # Прозрачность (например, после /nobg) в JPEG не сохранить
+                return bytes(data)
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format=fmt.upper(), quality=quality, optimize=fmt != "webp")
+        return out.getvalue()
+
+
+def _fit(data, target: int):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= target:
+            return None
+        image = image.convert("RGB")
+        image.thumbnail((target, target), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=90)
+        return out.getvalue()
+
+
+def pick_photo(photos, target: int = None):
+    """Самый маленький PhotoSize, длинная сторона которого не меньше target"""
+    if not target:
+        return photos[-1]
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if max(photo.width, photo.height) >= target:
+            return photo
+    return photos[-1]
+
+
+async def run(fn, *args):
+    """Выполняет обработку картинки в отдельном пуле"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+async def fit(data, target: int = None):
+    """Уменьшает фото до рабочего разрешения модели; меньшие отдает без изменений"""
+    if not target:
+        return data
+    with metrics.timer("image_fit"):
+        resized = await run(_fit, data, target)
+    if resized is None:
+        return data
+    # Счетчики Prometheus не убывают: вход и выход отдельно, экономия — их разность
+    metrics.inc("image_fit_bytes_in", len(data))
+    metrics.inc("image_fit_bytes_out", len(resized))
+    return resized
+
+
+async def finalize(data):
+    """Приводит результат к IMAGE_FORMAT; если формат уже нужный — отдает без копий"""
+    if not data or not IMAGE_FORMAT or sniff_format(data) == IMAGE_FORMAT:
+        return data
+    with metrics.timer("image_encode"):
+        encoded = await run(_encode, data, IMAGE_FORMAT, IMAGE_QUALITY)
+    metrics.inc("image_encode_bytes_in", len(data))
+    metrics.inc("image_encode_bytes_out", len(encoded))
+    return encoded
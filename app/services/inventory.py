@@ -0,0 +1,414 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+
+from app.services import metrics
+
+# Даты, время и вместимость берутся из config/events.json. Места держатся на время
+# оплаты (hold_minutes) и списываются, когда пользователь присылает чек.
+# Источник правды — база: с DATABASE_URL общая Postgres (несколько инстансов и
+# эфемерный диск Render), без нее — локальный SQLite. Проверка и бронь идут одной
+# транзакцией под блокировкой строки слота. В памяти — только копия счетчиков для
+# клавиатур, она обновляется после каждой брони и раз в INVENTORY_REFRESH
+EVENTS_CONFIG = os.getenv("EVENTS_CONFIG", "config/events.json")
+INVENTORY_PATH = os.getenv("INVENTORY_PATH", "data/inventory.sqlite3")
+INVENTORY_REFRESH = float(os.getenv("INVENTORY_REFRESH", 10))
+BACK_TO_DATES = "⬅️ Назад к датам"
+
+
+class Slot:
+    __slots__ = ("date", "time", "capacity", "sold", "held")
+
+    def __init__(self, date: str, time: str, capacity: int):
+        self.date = date
+        self.time = time
+        self.capacity = capacity
+        self.sold = 0
+        self.held = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.capacity - self.sold - self.held
+
+
+class SqliteBackend:
+    """Места в локальном файле: один процесс, данные живут, пока жив диск"""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS inventory_slots (
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            capacity INTEGER NOT NULL,
+            sold INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, time)
+        );
+        CREATE TABLE IF NOT EXISTS inventory_holds (
+            user_id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS inventory_sales (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            sold_at REAL NOT NULL
+        );
+        """)
+
+    def _transaction(self, fn, *args):
+        # BEGIN IMMEDIATE сразу берет блокировку записи — аналог FOR UPDATE
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return result
+
+    async def seed(self, slots):
+        self.conn.executemany(
+            "INSERT INTO inventory_slots (date, time, capacity) VALUES (?, ?, ?) "
+            "ON CONFLICT (date, time) DO UPDATE SET capacity = excluded.capacity",
+            slots
+        )
+
+    async def load(self, now):
+        return self.conn.execute("""
+            SELECT s.date, s.time, s.sold, COUNT(h.user_id) FROM inventory_slots s
+            LEFT JOIN inventory_holds h ON h.date = s.date AND h.time = s.time AND h.expires_at > ?
+            GROUP BY s.date, s.time, s.sold
+        """, (now,)).fetchall()
+
+    def _others(self, user_id, date, slot_time, now):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM inventory_holds WHERE date = ? AND time = ? AND expires_at > ? AND user_id != ?",
+            (date, slot_time, now, user_id)
+        ).fetchone()[0]
+
+    def _hold(self, user_id, date, slot_time, expires_at, now):
+        slot = self.conn.execute(
+            "SELECT capacity, sold FROM inventory_slots WHERE date = ? AND time = ?", (date, slot_time)
+        ).fetchone()
+        if slot is None or slot[1] + self._others(user_id, date, slot_time, now) >= slot[0]:
+            return False
+        self.conn.execute(
+            "INSERT INTO inventory_holds (user_id, date, time, expires_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET date = excluded.date, time = excluded.time, "
+            "expires_at = excluded.expires_at",
+            (user_id, date, slot_time, expires_at)
+        )
+        return True
+
+    async def hold(self, user_id, date, slot_time, expires_at, now):
+        return self._transaction(self._hold, user_id, date, slot_time, expires_at, now)
+
+    def _confirm(self, user_id, date, slot_time, now):
+        self.conn.execute("DELETE FROM inventory_holds WHERE user_id = ?", (user_id,))
+        others = self._others(user_id, date, slot_time, now)
+        sold = self.conn.execute(
+            "UPDATE inventory_slots SET sold = sold + 1 WHERE date = ? AND time = ? AND sold + 1 + ? <= capacity",
+            (date, slot_time, others)
+        ).rowcount
+        if not sold:
+            return False
+        self.conn.execute(
+            "INSERT INTO inventory_sales (user_id, date, time, sold_at) VALUES (?, ?, ?, ?)",
+            (user_id, date, slot_time, now)
+        )
+        return True
+
+    async def confirm(self, user_id, date, slot_time, now):
+        return self._transaction(self._confirm, user_id, date, slot_time, now)
+
+    async def release(self, user_id):
+        return self.conn.execute("DELETE FROM inventory_holds WHERE user_id = ?", (user_id,)).rowcount
+
+    async def expire(self, now):
+        return self.conn.execute("DELETE FROM inventory_holds WHERE expires_at <= ?", (now,)).rowcount
+
+
+class PostgresBackend:
+    """Места в общей базе — бронь атомарна между инстансами и переживает деплой.
+    Таблицы inventory_* создает миграция при подключении к базе"""
+
+    async def _pool(self):
+        from app.services.db import get_db
+        return await get_db()
+
+    async def seed(self, slots):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO inventory_slots (date, time, capacity) VALUES ($1, $2, $3) "
+                "ON CONFLICT (date, time) DO UPDATE SET capacity = EXCLUDED.capacity",
+                slots
+            )
+
+    async def load(self, now):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT s.date, s.time, s.sold, COUNT(h.user_id) AS held FROM inventory_slots s
+                LEFT JOIN inventory_holds h ON h.date = s.date AND h.time = s.time AND h.expires_at > $1
+                GROUP BY s.date, s.time, s.sold
+            """, now)
+        return [(row["date"], row["time"], row["sold"], row["held"]) for row in rows]
+
+    @staticmethod
+    async def _lock_slot(conn, user_id, date, slot_time, now):
+        """Блокирует строку слота до конца транзакции: (вместимость, продано, чужие брони) или None"""
+        slot = await conn.fetchrow(
+            "SELECT capacity, sold FROM inventory_slots WHERE date = $1 AND time = $2 FOR UPDATE", date, slot_time
+        )
+        if slot is None:
+            return None
+        others = await conn.fetchval(
+            "SELECT COUNT(*) FROM inventory_holds WHERE date = $1 AND time = $2 AND expires_at > $3 AND user_id <> $4",
+            date, slot_time, now, user_id
+        )
+        return slot["capacity"], slot["sold"], others
+
+    async def hold(self, user_id, date, slot_time, expires_at, now):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                slot = await self._lock_slot(conn, user_id, date, slot_time, now)
+                if slot is None or slot[1] + slot[2] >= slot[0]:
+                    return False
+                await conn.execute(
+                    "INSERT INTO inventory_holds (user_id, date, time, expires_at) VALUES ($1, $2, $3, $4) "
+                    "ON CONFLICT (user_id) DO UPDATE SET date = EXCLUDED.date, time = EXCLUDED.time, "
+                    "expires_at = EXCLUDED.expires_at",
+                    user_id, date, slot_time, expires_at
+                )
+        return True
+
+    async def confirm(self, user_id, date, slot_time, now):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                slot = await self._lock_slot(conn, user_id, date, slot_time, now)
+                await conn.execute("DELETE FROM inventory_holds WHERE user_id = $1", user_id)
+                if slot is None:
+                    return False
+                result = await conn.execute(
+                    "UPDATE inventory_slots SET sold = sold + 1 "
+                    "WHERE date = $1 AND time = $2 AND sold + 1 + $3 <= capacity",
+                    date, slot_time, slot[2]
+                )
+                if result.split()[-1] == "0":
+                    return False
+                await conn.execute(
+                    "INSERT INTO inventory_sales (user_id, date, time, sold_at) VALUES ($1, $2, $3, $4)",
+                    user_id, date, slot_time, now
+                )
+        return True
+
+    async def release(self, user_id):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            result = await conn.execute("DELETE FROM inventory_holds WHERE user_id = $1", user_id)
+        return int(result.split()[-1])
+
+    async def expire(self, now):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            result = await conn.execute("DELETE FROM inventory_holds WHERE expires_at <= $1", now)
+        return int(result.split()[-1])
+
+
+# label даты -> {"title": ..., "slots": {время: Slot}}; порядок — как в конфиге
+_dates = {}
+_keyboards = {}
+_backend = None
+_task = None
+_seeded = False
+_hold_ttl = 30 * 60
+
+
+def init_inventory(config_path: str = EVENTS_CONFIG):
+    """Читает каталог дат и мест; счетчики подтягивает start()"""
+    global _hold_ttl
+    if _dates:
+        return
+    with open(config_path, encoding="utf-8") as f:
+        catalog = json.load(f)
+    _hold_ttl = catalog.get("hold_minutes", 30) * 60
+    for date in catalog["dates"]:
+        _dates[date["label"]] = {
+            "title": date.get("title", date["label"]),
+            "slots": {s["time"]: Slot(date["label"], s["time"], s["capacity"]) for s in date["slots"]},
+        }
+    metrics.register("inventory", stats, labels={"slots": ("date", "time")})
+
+
+async def _sync():
+    """Заносит вместимость из конфига в базу (один раз) и перечитывает счетчики"""
+    global _seeded
+    if not _seeded:
+        await _backend.seed([(s.date, s.time, s.capacity) for info in _dates.values() for s in info["slots"].values()])
+        _seeded = True
+    await _refresh()
+
+
+async def _refresh():
+    changed = False
+    for date, slot_time, sold, held in await _backend.load(time.time()):
+        slot = get_slot(date, slot_time)
+        if slot is None:
+            continue
+        was_open = slot.remaining > 0
+        slot.sold, slot.held = sold, held
+        changed |= (slot.remaining > 0) != was_open
+    # Клавиатуры зависят только от того, есть ли в слоте места
+    if changed:
+        _keyboards.clear()
+
+
+async def _after_change():
+    try:
+        await _refresh()
+    except Exception as e:
+        logging.error(f"Inventory: счетчики не обновлены: {e}")
+
+
+async def _run():
+    while True:
+        try:
+            expired = await _backend.expire(time.time())
+            if expired:
+                metrics.inc("inventory_holds_expired", expired)
+            await _sync()
+        except Exception as e:
+            logging.error(f"Inventory: синхронизация с базой не удалась: {e}")
+        await asyncio.sleep(INVENTORY_REFRESH)
+
+
+async def start(config_path: str = EVENTS_CONFIG, path: str = INVENTORY_PATH):
+    """Подключает хранилище мест. Postgres подтягивается в фоне, чтобы не задерживать старт:
+    до первой синхронизации клавиатуры показывают все слоты, а бронь все равно проверяет база"""
+    global _backend, _task
+    init_inventory(config_path)
+    if _task is not None:
+        return
+    if os.getenv("DATABASE_URL"):
+        _backend = PostgresBackend()
+    else:
+        _backend = SqliteBackend(path)
+        await _sync()
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+
+
+def get_slot(date: str, slot_time: str):
+    date_info = _dates.get(date)
+    return date_info["slots"].get(slot_time) if date_info else None
+
+
+def is_date(label: str) -> bool:
+    return label in _dates
+
+
+def date_title(label: str) -> str:
+    """Название даты для таблицы и отчета; дату, убранную из конфига, отдает как есть"""
+    date_info = _dates.get(label)
+    return date_info["title"] if date_info else label
+
+
+def catalog() -> dict:
+    """Все даты и время, включая распроданные: label -> [время]"""
+    return {label: list(info["slots"]) for label, info in _dates.items()}
+
+
+def open_times(date: str) -> list:
+    return [t for t, slot in _dates[date]["slots"].items() if slot.remaining > 0]
+
+
+async def hold(user_id: int, date: str, slot_time: str) -> bool:
+    """Держит место за пользователем на время оплаты (прежняя бронь переносится). False — мест нет"""
+    if get_slot(date, slot_time) is None:
+        return False
+    if not _seeded:
+        await _sync()
+    now = time.time()
+    ok = await _backend.hold(user_id, date, slot_time, now + _hold_ttl, now)
+    if not ok:
+        metrics.inc("inventory_sold_out")
+    await _after_change()
+    return ok
+
+
+async def release(user_id: int):
+    """Отпускает бронь (вернулся к выбору даты или начал заново)"""
+    if await _backend.release(user_id):
+        await _after_change()
+
+
+async def confirm(user_id: int, date: str, slot_time: str) -> bool:
+    """Продает место по броне. Бронь истекла — берет свободное, если оно есть.
+    False — слот уже распродан (оплата пришла сверх вместимости)"""
+    if get_slot(date, slot_time) is None:
+        return False
+    if not _seeded:
+        await _sync()
+    ok = await _backend.confirm(user_id, date, slot_time, time.time())
+    metrics.inc("inventory_sold" if ok else "inventory_overbooked")
+    await _after_change()
+    return ok
+
+
+def dates_keyboard():
+    """Даты, где еще есть места; None — все распродано"""
+    kb = _keyboards.get(None)
+    if kb is None:
+        labels = [label for label in _dates if open_times(label)]
+        kb = ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text=label)] for label in labels], resize_keyboard=True
+        ) if labels else False
+        _keyboards[None] = kb
+    return kb or None
+
+
+def times_keyboard(date: str) -> ReplyKeyboardMarkup:
+    kb = _keyboards.get(date)
+    if kb is None:
+        buttons = [[KeyboardButton(text=t)] for t in open_times(date)]
+        buttons.append([KeyboardButton(text=BACK_TO_DATES)])
+        kb = _keyboards[date] = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    return kb
+
+
+def stats() -> dict:
+    return {
+        "holds": sum(slot.held for info in _dates.values() for slot in info["slots"].values()),
+        "slots": {
+            label: {t: {"sold": slot.sold, "held": slot.held, "remaining": slot.remaining}
+                    for t, slot in info["slots"].items()}
+            for label, info in _dates.items()
+        },
+    }
@@ -0,0 +1,184 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+from app.services import metrics
+
+# Очередь тяжелых задач с картинками: воркеров ограниченное число,
+# дешевые задачи идут раньше, пользователи внутри класса — по кругу
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 3))
+IMAGE_JOBS_PER_USER = int(os.getenv("IMAGE_JOBS_PER_USER", 3))
+
+PRIORITY_FAST = 0      # /nobg
+PRIORITY_NORMAL = 1    # /style, лицо, апскейл
+PRIORITY_HEAVY = 2     # генерация FLUX
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    priority: int
+    run: object
+    on_position: object = None
+    on_done: object = None
+    position: int = 0
+    task: asyncio.Task = field(default=None, repr=False)
+
+
+_ids = itertools.count(1)
+# priority -> OrderedDict(user_id -> deque[Job])
+_queues = {PRIORITY_FAST: OrderedDict(), PRIORITY_NORMAL: OrderedDict(), PRIORITY_HEAVY: OrderedDict()}
+_running = {}
+_ready = None
+_workers = []
+
+
+def _order():
+    """Очередные задачи в порядке запуска"""
+    for users in _queues.values():
+        pending = [deque(jobs) for jobs in users.values()]
+        while pending:
+            for jobs in pending:
+                yield jobs.popleft()
+            pending = [jobs for jobs in pending if jobs]
+
+
+def _notify_positions():
+    for position, job in enumerate(_order(), start=1):
+        if job.position != position:
+            job.position = position
+            _callback(job, position)
+
+
+def _callback(job: Job, position: int):
+    if job.on_position is None:
+        return
+    try:
+        job.on_position(position)
+    except Exception as e:
+        logging.warning(f"Job {job.id} position update failed: {e}")
+
+
+async def _done(job: Job):
+    if job.on_done is None:
+        return
+    try:
+        await job.on_done()
+    except Exception as e:
+        logging.warning(f"Job {job.id} cleanup failed: {e}")
+
+
+def queued_for(user_id: int) -> int:
+    return sum(len(users.get(user_id, ())) for users in _queues.values()) + \
+        sum(1 for job in _running.values() if job.user_id == user_id)
+
+
+def submit(user_id: int, priority: int, run, on_position=None, on_done=None):
+    """Ставит задачу в очередь. None — если у пользователя уже слишком много задач.
+
+    on_position(n) вызывается при смене места в очереди, 0 — задача запущена;
+    on_done() — после завершения, ошибки или отмены задачи.
+    """
+    if queued_for(user_id) >= IMAGE_JOBS_PER_USER:
+        metrics.inc("jobs_rejected")
+        return None
+    job = Job(next(_ids), user_id, priority, run, on_position, on_done)
+    _queues[priority].setdefault(user_id, deque()).append(job)
+    metrics.inc("jobs_submitted")
+    _ensure_workers()
+    _ready.set()
+    _notify_positions()
+    return job
+
+
+def cancel(job: Job) -> bool:
+    """Отменяет задачу: из очереди просто убирает, у запущенной отменяет task.
+
+    Отмена доходит до await внутри run(): HTTP-запрос к провайдеру обрывается,
+    слот воркера освобождается сразу.
+    """
+    if job.id in _running:
+        if job.task is None or job.task.done():
+            return False
+        job.task.cancel()
+        metrics.inc("jobs_cancelled")
+        return True
+
+    users = _queues[job.priority]
+    queued = users.get(job.user_id)
+    if not queued or job not in queued:
+        return False
+    queued.remove(job)
+    if not queued:
+        del users[job.user_id]
+    metrics.inc("jobs_cancelled")
+    _notify_positions()
+    asyncio.create_task(_done(job))
+    return True
+
+
+def _pop():
+    for users in _queues.values():
+        if users:
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            return job
+    return None
+
+
+async def _worker():
+    while True:
+        job = _pop()
+        if job is None:
+            _ready.clear()
+            await _ready.wait()
+            continue
+
+        _running[job.id] = job
+        job.position = 0
+        _callback(job, 0)
+        _notify_positions()
+        try:
+            job.task = asyncio.create_task(job.run())
+            with metrics.timer("job", {"priority": job.priority}):
+                await asyncio.wait({job.task})
+            if not job.task.cancelled() and job.task.exception():
+                logging.error(f"Job {job.id} failed: {job.task.exception()}")
+        finally:
+            _running.pop(job.id, None)
+            await _done(job)
+
+
+def _ensure_workers():
+    global _ready
+    if _ready is None:
+        _ready = asyncio.Event()
+    while len(_workers) < IMAGE_WORKERS:
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    for job in list(_running.values()):
+        job.task.cancel()
+    _workers.clear()
+
+
+def stats() -> dict:
+    return {
+        "workers": IMAGE_WORKERS,
+        "running": len(_running),
+        "queued": {p: sum(len(j) for j in users.values()) for p, users in _queues.items()},
+    }
+
+
+metrics.register("image_jobs", stats, labels={"queued": "priority"})
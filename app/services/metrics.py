@@ -0,0 +1,216 @@
+import asyncio
+import bisect
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Сколько последних замеров храним на каждую метрику
+WINDOW = 500
+# Границы гистограмм для Prometheus, в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PREFIX = "fambot"
+LOOP_LAG_INTERVAL = 0.5
+
+_timings = {}
+_counters = {}
+_collectors = {}
+# имя сборщика -> {ключ: имена меток}: уровни под этим ключом — метки, а не части имени
+_collector_labels = {}
+# (имя, метки) -> [счетчики по корзинам..., +Inf], сумма в секундах
+_histograms = {}
+_loop_lag_ms = 0.0
+_loop_task = None
+# Этапы запуска: имя -> мс от начала импорта main.py; точку отсчета задает boot()
+_startup = {}
+_boot = time.perf_counter()
+
+
+def _series(name: str, labels: dict = None) -> str:
+    return name + _labels(tuple(sorted(labels.items())) if labels else ())
+
+
+def inc(name: str, value: float = 1, labels: dict = None):
+    """Увеличивает счётчик"""
+    key = _series(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, ms: float, labels: dict = None):
+    """Записывает длительность операции в миллисекундах"""
+    key = _series(name, labels)
+    samples = _timings.get(key)
+    if samples is None:
+        samples = _timings.setdefault(key, deque(maxlen=WINDOW))
+    samples.append(ms)
+
+    hist_key = (name, tuple(sorted(labels.items())) if labels else ())
+    hist = _histograms.get(hist_key)
+    if hist is None:
+        hist = _histograms.setdefault(hist_key, [[0] * (len(BUCKETS) + 1), 0.0])
+    hist[0][bisect.bisect_left(BUCKETS, ms / 1000)] += 1
+    hist[1] += ms / 1000
+
+
+@contextmanager
+def timer(name: str, labels: dict = None):
+    """Замеряет время выполнения блока"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - started) * 1000, labels)
+
+
+def register(name: str, fn, labels: dict = None):
+    """Регистрирует функцию, которая отдает текущее состояние подсистемы.
+
+    labels описывает словари с динамическими ключами (приоритеты, провайдеры, слоты):
+    {"queued": "priority"} — ключи внутри "queued" уходят в метку priority;
+    кортеж имен — столько уровней подряд; ключ "" — верхний уровень сборщика.
+    """
+    _collectors[name] = fn
+    _collector_labels[name] = {
+        key: (names,) if isinstance(names, str) else tuple(names) for key, names in (labels or {}).items()
+    }
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _gauges() -> dict:
+    gauges = {}
+    for name, fn in list(_collectors.items()):
+        try:
+            gauges[name] = fn()
+        except Exception as e:
+            gauges[name] = {"error": str(e)}
+    return gauges
+
+
+def snapshot() -> dict:
+    """Сводка по всем метрикам для статус-эндпоинта"""
+    timings = {}
+    for name, samples in list(_timings.items()):
+        values = sorted(samples)
+        if not values:
+            continue
+        timings[name] = {
+            "count": len(values),
+            "avg_ms": round(sum(values) / len(values), 1),
+            "p50_ms": round(_percentile(values, 0.5), 1),
+            "p95_ms": round(_percentile(values, 0.95), 1),
+            "max_ms": round(values[-1], 1),
+        }
+
+    return {"timings": timings, "counters": dict(_counters), "gauges": _gauges()}
+
+
+# ====== PROMETHEUS ======
+
+def _metric_name(*parts) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join((PREFIX,) + parts))
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _flatten(prefix: tuple, value, out: list, spec: dict, pairs: tuple = (), pending: tuple = ()):
+    """Числовые значения из вложенных словарей сборщиков: (части имени, метки, значение).
+    pending — имена меток для ближайших уровней ключей"""
+    if isinstance(value, bool):
+        out.append((prefix, pairs, int(value)))
+    elif isinstance(value, (int, float)):
+        out.append((prefix, pairs, value))
+    elif isinstance(value, dict):
+        for key, nested in value.items():
+            if pending:
+                _flatten(prefix, nested, out, spec, pairs + ((pending[0], key),), pending[1:])
+            else:
+                _flatten(prefix + (str(key),), nested, out, spec, pairs, spec.get(str(key), ()))
+
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+
+    counters = {}
+    for key, value in list(_counters.items()):
+        name, _, labels = key.partition("{")
+        counters.setdefault(name, []).append((("{" + labels) if labels else "", value))
+    for name, series in sorted(counters.items()):
+        metric = _metric_name(name, "total")
+        lines.append(f"# TYPE {metric} counter")
+        lines.extend(f"{metric}{labels} {value}" for labels, value in series)
+
+    histograms = {}
+    for (name, pairs), (counts, total) in list(_histograms.items()):
+        histograms.setdefault(name, []).append((pairs, list(counts), total))
+    for name, series in sorted(histograms.items()):
+        metric = _metric_name(name, "seconds")
+        lines.append(f"# TYPE {metric} histogram")
+        for pairs, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_labels(pairs + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_sum{_labels(pairs)} {round(total, 6)}")
+            lines.append(f"{metric}_count{_labels(pairs)} {cumulative}")
+
+    values = []
+    for name, value in _gauges().items():
+        spec = _collector_labels.get(name, {})
+        _flatten((name,), value, values, spec, (), spec.get("", ()))
+    values.append((("event_loop_lag_current_seconds",), (), _loop_lag_ms / 1000))
+    gauges = {}
+    for parts, pairs, value in values:
+        gauges.setdefault(_metric_name(*parts), []).append((pairs, value))
+    for metric, series in gauges.items():
+        lines.append(f"# TYPE {metric} gauge")
+        lines.extend(f"{metric}{_labels(pairs)} {value}" for pairs, value in series)
+
+    return "\n".join(lines) + "\n"
+
+
+# ====== ЗАДЕРЖКА ЦИКЛА СОБЫТИЙ ======
+
+async def _watch_loop():
+    global _loop_lag_ms
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        _loop_lag_ms = max(0.0, (time.perf_counter() - started - LOOP_LAG_INTERVAL) * 1000)
+        observe("event_loop_lag", _loop_lag_ms)
+
+
+def start_loop_monitor():
+    """Фоновый замер: насколько позже срока просыпается sleep — столько цикл был занят"""
+    global _loop_task
+    if _loop_task is None:
+        _loop_task = asyncio.create_task(_watch_loop())
+
+
+def loop_lag_ms() -> float:
+    return _loop_lag_ms
+
+
+# ====== ЗАПУСК ======
+
+def boot(started: float):
+    """Задает точку отсчета этапов запуска (perf_counter до тяжелых импортов)"""
+    global _boot
+    _boot = started
+
+
+def startup_phase(name: str):
+    """Отмечает этап запуска, только первый раз; в /stats и /metrics — gauge startup_ms"""
+    if name not in _startup:
+        _startup[name] = round((time.perf_counter() - _boot) * 1000, 1)
+
+
+register("startup_ms", lambda: dict(_startup), labels={"": "phase"})
@@ -0,0 +1,96 @@
+import logging
+import time
+
+# Схема Postgres. Новые изменения — только новой записью в конце списка:
+# примененные версии хранятся в schema_migrations и повторно не выполняются.
+# Первые версии написаны через IF NOT EXISTS — на старых базах эти таблицы уже есть
+MIGRATIONS = [
+    (1, "reputation and shopping list", """
+        CREATE TABLE IF NOT EXISTS reputation (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT,
+            score INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS shopping_list (
+            id SERIAL PRIMARY KEY,
+            item TEXT
+        );
+    """),
+    (2, "reputation score index", """
+        CREATE INDEX IF NOT EXISTS reputation_score_idx ON reputation (score DESC, user_id DESC);
+    """),
+    (3, "reputation batches", """
+        CREATE TABLE IF NOT EXISTS reputation_batches (
+            batch TEXT PRIMARY KEY,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    (4, "rate limits", """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        );
+    """),
+    (5, "fsm state", """
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at DOUBLE PRECISION NOT NULL
+        );
+    """),
+    (6, "seat inventory", """
+        CREATE TABLE inventory_slots (
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            capacity INTEGER NOT NULL,
+            sold INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, time)
+        );
+        CREATE TABLE inventory_holds (
+            user_id BIGINT PRIMARY KEY,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            expires_at DOUBLE PRECISION NOT NULL
+        );
+        CREATE INDEX inventory_holds_slot_idx ON inventory_holds (date, time);
+        CREATE TABLE inventory_sales (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            sold_at DOUBLE PRECISION NOT NULL
+        );
+    """),
+]
+
+# Произвольная константа: ключ pg_advisory_lock, общий для всех инстансов бота
+LOCK_KEY = 0x66616D626F74
+
+
+async def run(pool):
+    """Применяет недостающие миграции. Несколько инстансов ждут друг друга на advisory lock"""
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", LOCK_KEY)
+        try:
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """)
+            applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, name, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                started = time.perf_counter()
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name
+                    )
+                logging.info(f"Migration {version} ({name}) applied in {time.perf_counter() - started:.2f}s")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", LOCK_KEY)
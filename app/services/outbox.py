@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+from app.services import metrics
+
+# Локальная очередь заявок: оплата подтверждается сразу после записи сюда,
+# а выгрузка в Google идет в фоне с повторами
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "data/outbox.sqlite3")
+DRAIN_BATCH = int(os.getenv("OUTBOX_DRAIN_BATCH", 10))
+MAX_BACKOFF = 600
+
+_conn = None
+_wakeup = None
+_task = None
+
+
+def init_outbox(path: str = OUTBOX_PATH):
+    """Открывает базу очереди (SQLite в режиме WAL)"""
+    global _conn
+    if _conn is not None:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    _conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=NORMAL")
+    _conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE NOT NULL,
+        payload TEXT NOT NULL,
+        file_id TEXT,
+        created_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_try REAL NOT NULL DEFAULT 0,
+        drive_link TEXT,
+        last_error TEXT,
+        done_at REAL
+    )
+    """)
+    _conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (next_try) WHERE done_at IS NULL")
+    metrics.register("outbox", stats)
+
+
+def put(key: str, data: dict, file_id: str) -> int:
+    """Сохраняет заявку; повтор с тем же ключом игнорируется. Возвращает длину очереди"""
+    _conn.execute(
+        "INSERT OR IGNORE INTO outbox (key, payload, file_id, created_at) VALUES (?, ?, ?, ?)",
+        (key, json.dumps(data, ensure_ascii=False), file_id, time.time())
+    )
+    metrics.inc("outbox_put")
+    if _wakeup is not None:
+        _wakeup.set()
+    return depth()
+
+
+def depth() -> int:
+    return _conn.execute("SELECT COUNT(*) FROM outbox WHERE done_at IS NULL").fetchone()[0]
+
+
+def stats() -> dict:
+    """Длина очереди и возраст самой старой невыгруженной заявки"""
+    count, oldest = _conn.execute(
+        "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE done_at IS NULL"
+    ).fetchone()
+    return {
+        "depth": count,
+        "oldest_age_sec": round(time.time() - oldest, 1) if oldest else 0,
+    }
+
+
+def mark_uploaded(entry_id: int, drive_link: str):
+    """Запоминает ссылку на чек, чтобы при повторе не грузить его снова"""
+    _conn.execute("UPDATE outbox SET drive_link = ? WHERE id = ?", (drive_link, entry_id))
+
+
+def _due(limit: int) -> list[dict]:
+    rows = _conn.execute(
+        "SELECT id, key, payload, file_id, created_at, attempts, drive_link FROM outbox "
+        "WHERE done_at IS NULL AND next_try <= ? ORDER BY id LIMIT ?",
+        (time.time(), limit)
+    ).fetchall()
+    return [
+        {
+            "id": row[0], "key": row[1], "data": json.loads(row[2]), "file_id": row[3],
+            "created_at": row[4], "attempts": row[5], "drive_link": row[6],
+        }
+        for row in rows
+    ]
+
+
+def _next_due_in() -> float:
+    row = _conn.execute("SELECT MIN(next_try) FROM outbox WHERE done_at IS NULL").fetchone()
+    if row[0] is None:
+        return 5
+    return max(0.0, min(5, row[0] - time.time()))
+
+
+async def _handle(entry, process):
+    # Попытка засчитывается до начала: если процесс убьют или drainer отменят посреди
+    # выгрузки, следующая попытка увидит attempts > 0 и проверит, что уже загружено
+    attempts = entry["attempts"] + 1
+    _conn.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (attempts, entry["id"]))
+    try:
+        with metrics.timer("outbox_process"):
+            await process(entry)
+    except Exception as e:
+        delay = min(MAX_BACKOFF, 2 ** attempts) * random.uniform(0.8, 1.2)
+        _conn.execute(
+            "UPDATE outbox SET next_try = ?, last_error = ? WHERE id = ?",
+            (time.time() + delay, str(e)[:500], entry["id"])
+        )
+        metrics.inc("outbox_retry")
+        logging.error(f"Заявка {entry['key']} не выгружена (попытка {attempts}): {e}")
+        return
+    _conn.execute("UPDATE outbox SET done_at = ?, last_error = NULL WHERE id = ?", (time.time(), entry["id"]))
+    metrics.inc("outbox_done")
+    metrics.observe("outbox_latency", (time.time() - entry["created_at"]) * 1000)
+
+
+async def _drain(process):
+    while True:
+        entries = _due(DRAIN_BATCH)
+        if entries:
+            await asyncio.gather(*(_handle(entry, process) for entry in entries))
+            continue
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), _next_due_in())
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_drainer(process):
+    """Запускает фоновую выгрузку; process(entry) должен бросать исключение при неудаче"""
+    global _wakeup, _task
+    if _task is not None:
+        return
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_drain(process))
+
+
+async def stop_drainer():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
+
+from app.services import metrics
+
+# Статусные сообщения долгих задач. Правки копятся и уходят не чаще, чем
+# позволяет Telegram: в группах ~20 сообщений в минуту, в личке ~1 в секунду
+TICK = 1.0
+PRIVATE_INTERVAL = 2.0
+GROUP_INTERVAL = 4.0
+EDITS_PER_TICK = 20
+# Время выполнения показываем, только если задача идет дольше этого
+SHOW_ELAPSED_AFTER = 5
+
+_ids = itertools.count(1)
+_active = {}
+_chat_ready = {}
+_task = None
+
+
+class Progress:
+    """Статус одной задачи: место в очереди, время выполнения, кнопка отмены"""
+
+    def __init__(self, status: Message, text: str, user_id: int):
+        self.id = next(_ids)
+        self.status = status
+        self.text = text
+        self.user_id = user_id
+        self.job = None
+        self.position = 0
+        self.started_at = None
+        self.final_text = None
+        self.shown = text
+
+    @property
+    def keyboard(self):
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="✖️ Отмена", callback_data=f"cancel_job:{self.id}")
+        ]])
+
+    def render(self) -> str:
+        if self.position:
+            return f"{self.text}\n⏳ Место в очереди: {self.position}"
+        if self.started_at is not None:
+            elapsed = int(time.monotonic() - self.started_at)
+            if elapsed >= SHOW_ELAPSED_AFTER:
+                return f"{self.text}\n⏱ {elapsed} сек."
+        return self.text
+
+    def set_position(self, position: int):
+        """Колбэк очереди: 0 — задача запущена"""
+        self.position = position
+        if position == 0 and self.started_at is None:
+            self.started_at = time.monotonic()
+
+    def fail(self, text: str):
+        """Оставить статусное сообщение с этим текстом вместо удаления"""
+        self.final_text = text
+
+    async def finish(self):
+        _active.pop(self.id, None)
+        try:
+            if self.final_text:
+                await self.status.edit_text(self.final_text)
+            else:
+                await self.status.delete()
+        except TelegramBadRequest:
+            pass
+
+
+async def report(message: Message, text: str, user_id: int = None) -> Progress:
+    """Отправляет статусное сообщение с кнопкой отмены и начинает его обновлять"""
+    global _task
+    progress = Progress(None, text, user_id or message.from_user.id)
+    progress.status = await message.answer(text, reply_markup=progress.keyboard)
+    _active[progress.id] = progress
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+    return progress
+
+
+def get(progress_id: int):
+    return _active.get(progress_id)
+
+
+async def _edit(progress: Progress, text: str):
+    chat_id = progress.status.chat.id
+    try:
+        await progress.status.edit_text(text, reply_markup=progress.keyboard)
+        progress.shown = text
+        metrics.inc("progress_edits")
+    except TelegramRetryAfter as e:
+        _chat_ready[chat_id] = time.monotonic() + e.retry_after
+        metrics.inc("progress_flood_wait")
+    except TelegramBadRequest:
+        # Сообщение удалено или текст не изменился
+        progress.shown = text
+    except Exception as e:
+        # Сбой сети или 5xx: попробуем на следующем тике, цикл обновлений не должен падать
+        logging.warning(f"Progress update failed: {e}")
+
+
+async def _run():
+    while _active:
+        await asyncio.sleep(TICK)
+        now = time.monotonic()
+        edits = []
+        for progress in list(_active.values()):
+            if len(edits) >= EDITS_PER_TICK:
+                break
+            text = progress.render()
+            chat_id = progress.status.chat.id
+            if text == progress.shown or _chat_ready.get(chat_id, 0) > now:
+                continue
+            # Несколько задач в одном чате делят один лимит правок
+            _chat_ready[chat_id] = now + (GROUP_INTERVAL if chat_id < 0 else PRIVATE_INTERVAL)
+            edits.append(_edit(progress, text))
+        if edits:
+            await asyncio.gather(*edits)
+        for chat_id in [c for c, ready in _chat_ready.items() if ready < now]:
+            del _chat_ready[chat_id]
+
+
+def stats() -> dict:
+    return {"active": len(_active)}
+
+
+metrics.register("progress", stats)
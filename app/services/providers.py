@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from app.services import metrics
+
+# Выбор бэкенда генерации: самый быстрый из здоровых, упавшие — на паузу
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 3))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", 0.5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+BREAKER_MAX_COOLDOWN = 300
+# GEN_HEDGE=1 — если основной бэкенд дольше своего p95, параллельно запускаем следующий
+GEN_HEDGE = os.getenv("GEN_HEDGE", "0") == "1"
+MIN_SAMPLES = 5
+
+
+class Provider:
+    """Бэкенд со скользящей статистикой и автоматом-предохранителем"""
+
+    def __init__(self, name: str, call):
+        self.name = name
+        self.call = call
+        self.latencies = deque(maxlen=50)
+        self.results = deque(maxlen=20)
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.opened_until = 0.0
+        self.probing = False
+
+    def _percentile(self, q: float):
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+    @property
+    def p50(self):
+        return self._percentile(0.5)
+
+    @property
+    def p95(self):
+        return self._percentile(0.95)
+
+    @property
+    def state(self) -> str:
+        if self.opened_until == 0:
+            return "closed"
+        return "open" if time.monotonic() < self.opened_until else "half_open"
+
+    def available(self) -> bool:
+        state = self.state
+        # В полуоткрытом состоянии пропускаем только одну пробную попытку
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def record(self, ok: bool, ms: float):
+        self.results.append(ok)
+        if ok:
+            self.latencies.append(ms)
+            self.failures = 0
+            self.opened_until = 0.0
+            self.cooldown = BREAKER_COOLDOWN
+            return
+
+        self.failures += 1
+        error_rate = self.results.count(False) / len(self.results)
+        if self.state == "half_open" or self.failures >= BREAKER_FAILURES or \
+                (len(self.results) >= 10 and error_rate >= BREAKER_ERROR_RATE):
+            if self.state == "half_open":
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self.opened_until = time.monotonic() + self.cooldown
+            metrics.inc("breaker_open", labels={"provider": self.name})
+            logging.warning(f"⚠️ {self.name} отключен на {self.cooldown:.0f} сек.")
+
+    def health(self) -> dict:
+        return {
+            "state": self.state,
+            "p50_ms": round(self.p50, 1) if self.p50 is not None else None,
+            "p95_ms": round(self.p95, 1) if self.p95 is not None else None,
+            "error_rate": round(self.results.count(False) / len(self.results), 2) if self.results else 0,
+            "consecutive_failures": self.failures,
+        }
+
+
+_registry = {}
+
+
+def register(name: str, call) -> Provider:
+    provider = Provider(name, call)
+    _registry[name] = provider
+    return provider
+
+
+def _ranked(providers):
+    available = [p for p in providers if p.available()]
+    if not available:
+        # Все на паузе — пробуем тот, чья пауза закончится раньше
+        return sorted(providers, key=lambda p: p.opened_until)[:1]
+    # Без статистики считаем бэкенд быстрым, чтобы он ее набрал
+    return sorted(available, key=lambda p: p.p50 or 0)
+
+
+async def _attempt(provider: Provider, *args):
+    half_open = provider.state == "half_open"
+    if half_open:
+        provider.probing = True
+    started = time.perf_counter()
+    try:
+        result = await provider.call(*args)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.warning(f"⚠️ {provider.name} failed: {e}")
+        result = None
+    finally:
+        if half_open:
+            provider.probing = False
+    ms = (time.perf_counter() - started) * 1000
+    provider.record(result is not None, ms)
+    metrics.observe("provider", ms, {"provider": provider.name})
+    return result
+
+
+async def route(providers, *args):
+    """Вызывает бэкенды по порядку скорости до первого успешного ответа"""
+    order = _ranked(providers)
+    pending = set()
+    launched = []
+
+    def launch():
+        provider = order[len(launched)]
+        launched.append(provider)
+        pending.add(asyncio.create_task(_attempt(provider, *args)))
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if GEN_HEDGE and len(launched) < len(order) and launched[-1].p95 is not None:
+                timeout = launched[-1].p95 / 1000
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.discard(task)
+                if task.result() is not None:
+                    if len(launched) > 1:
+                        metrics.inc("provider_failover")
+                    return task.result()
+            # Ошибка или ответ дольше p95 — подключаем следующий бэкенд
+            if len(launched) < len(order):
+                launch()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def health() -> dict:
+    return {name: provider.health() for name, provider in _registry.items()}
+
+
+metrics.register("providers", health, labels={"": "provider"})
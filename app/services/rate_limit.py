@@ -0,0 +1,127 @@
+import os
+import time
+
+from app.services import metrics
+
+# Token bucket: (емкость, токенов в секунду). Пользователь и чат ограничиваются отдельно
+USER_LIMITS = {
+    "gen": (1, 1 / 20),
+    "style": (2, 1 / 15),
+    "nobg": (3, 1 / 10),
+    "enhance": (3, 1 / 10),
+}
+CHAT_LIMITS = {
+    "gen": (5, 1 / 6),
+    "style": (5, 1 / 5),
+    "nobg": (10, 1 / 3),
+    "enhance": (10, 1 / 3),
+}
+# RATE_LIMIT_BACKEND=postgres — общие лимиты для нескольких инстансов
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+SWEEP_INTERVAL = 60
+
+# key -> [токены, время обновления]
+_buckets = {}
+_last_sweep = time.monotonic()
+_last_pg_sweep = 0.0
+
+
+def _refill(bucket, capacity, rate, now):
+    return min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+
+def _sweep(now):
+    """Удаляет корзины, которые уже успели наполниться — они не отличаются от новых"""
+    global _last_sweep
+    _last_sweep = now
+    full = []
+    for key, bucket in _buckets.items():
+        capacity, rate = key[2]
+        if _refill(bucket, capacity, rate, now) >= capacity:
+            full.append(key)
+    for key in full:
+        del _buckets[key]
+
+
+def _consume_memory(checks):
+    now = time.monotonic()
+    if now - _last_sweep > SWEEP_INTERVAL:
+        _sweep(now)
+
+    wait = 0.0
+    levels = []
+    for key in checks:
+        capacity, rate = key[2]
+        bucket = _buckets.get(key)
+        tokens = capacity if bucket is None else _refill(bucket, capacity, rate, now)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+        levels.append((key, tokens))
+    if wait:
+        return wait
+
+    for key, tokens in levels:
+        _buckets[key] = [tokens - 1, now]
+    return None
+
+
+class _Denied(Exception):
+    def __init__(self, wait):
+        self.wait = wait
+
+
+async def _consume_postgres(checks):
+    global _last_pg_sweep
+    from app.services.db import get_db
+    pool = await get_db()
+    now = time.time()
+    async with pool.acquire() as conn:
+        if now - _last_pg_sweep > SWEEP_INTERVAL:
+            # Час без обращений — корзина точно полная, строка не нужна
+            _last_pg_sweep = now
+            await conn.execute("DELETE FROM rate_limits WHERE updated_at < $1", now - 3600)
+        async with conn.transaction():
+            for kind, ident, (capacity, rate) in checks:
+                # Пополнение и списание одним атомарным запросом; нет строки — токенов нет
+                row = await conn.fetchrow("""
+                    INSERT INTO rate_limits AS b (key, tokens, updated_at) VALUES ($1, $2 - 1, $3)
+                    ON CONFLICT (key) DO UPDATE SET
+                        tokens = LEAST($2, b.tokens + ($3 - b.updated_at) * $4) - 1,
+                        updated_at = $3
+                    WHERE LEAST($2, b.tokens + ($3 - b.updated_at) * $4) >= 1
+                    RETURNING tokens
+                """, f"{kind}:{ident}", capacity, now, rate)
+                if row is None:
+                    wait = await conn.fetchval(
+                        "SELECT (1 - LEAST($2, tokens + ($3 - updated_at) * $4)) / $4 FROM rate_limits WHERE key = $1",
+                        f"{kind}:{ident}", capacity, now, rate
+                    )
+                    # Откатываем списания у уже проверенных корзин
+                    raise _Denied(wait or 1)
+    return None
+
+
+async def consume(name: str, user_id: int, chat_id: int = None):
+    """Списывает токен у пользователя и чата. None — можно, иначе сколько секунд ждать"""
+    checks = []
+    if name in USER_LIMITS:
+        checks.append((f"{name}:u", user_id, USER_LIMITS[name]))
+    if chat_id is not None and chat_id != user_id and name in CHAT_LIMITS:
+        checks.append((f"{name}:c", chat_id, CHAT_LIMITS[name]))
+    if not checks:
+        return None
+
+    if RATE_LIMIT_BACKEND == "postgres":
+        try:
+            wait = await _consume_postgres(checks)
+        except _Denied as denied:
+            wait = denied.wait
+    else:
+        wait = _consume_memory(checks)
+
+    if wait is not None:
+        metrics.inc("rate_limited", labels={"limit": name})
+    return wait
+
+
+metrics.register("rate_limit", lambda: {"buckets": len(_buckets)})
@@ -0,0 +1,203 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+
+from app.services import metrics
+from app.services.db import get_db
+
+# «+» копятся в памяти и уходят в базу одним запросом раз в REP_FLUSH_INTERVAL.
+# Каждое начисление сначала дописывается в журнал, поэтому падение процесса
+# ничего не теряет: при старте журнал применяется заново
+REP_WAL_PATH = os.getenv("REP_WAL_PATH", "data/reputation.wal")
+REP_FLUSH_INTERVAL = float(os.getenv("REP_FLUSH_INTERVAL", 2))
+
+# user_id -> [имя, сумма начислений]
+_pending = {}
+# user_id -> счет в базе на момент последнего чтения или сброса
+_scores = {}
+_wal = None
+_task = None
+_lock = asyncio.Lock()
+
+
+def _open_wal():
+    global _wal
+    if os.path.dirname(REP_WAL_PATH):
+        os.makedirs(os.path.dirname(REP_WAL_PATH), exist_ok=True)
+    _wal = open(REP_WAL_PATH, "a", encoding="utf-8")
+
+
+def _rotate() -> str:
+    """Закрывает текущий журнал под именем партии и открывает новый"""
+    batch = f"{REP_WAL_PATH}.{time.time_ns()}"
+    _wal.flush()
+    os.fsync(_wal.fileno())
+    _wal.close()
+    os.replace(REP_WAL_PATH, batch)
+    _open_wal()
+    return batch
+
+
+def add(user_id: int, name: str, delta: int = 1):
+    """Начисляет репутацию; в базу попадет при ближайшем сбросе"""
+    if _wal is None:
+        _open_wal()
+    _wal.write(json.dumps({"user_id": user_id, "name": name, "delta": delta}, ensure_ascii=False) + "\n")
+    _wal.flush()
+    entry = _pending.setdefault(user_id, [name, 0])
+    entry[0] = name
+    entry[1] += delta
+    metrics.inc("rep_added")
+
+
+def _read_batch(path: str) -> dict:
+    totals = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Недописанная строка при падении
+                continue
+            entry = totals.setdefault(record["user_id"], [record["name"], 0])
+            entry[0] = record["name"]
+            entry[1] += record["delta"]
+    return totals
+
+
+def _batches() -> list[str]:
+    return sorted(glob.glob(f"{glob.escape(REP_WAL_PATH)}.*"))
+
+
+async def _apply(path: str, totals: dict) -> bool:
+    """Применяет партию ровно один раз: имя партии пишется в той же транзакции"""
+    batch = os.path.basename(path)
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            fresh = await conn.fetchval(
+                "INSERT INTO reputation_batches (batch) VALUES ($1) ON CONFLICT DO NOTHING RETURNING true",
+                batch
+            )
+            if fresh and totals:
+                await conn.execute("""
+                    INSERT INTO reputation (user_id, name, score)
+                    SELECT * FROM UNNEST($1::bigint[], $2::text[], $3::int[])
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        score = reputation.score + EXCLUDED.score,
+                        name = EXCLUDED.name
+                """, list(totals), [v[0] for v in totals.values()], [v[1] for v in totals.values()])
+            await conn.execute("DELETE FROM reputation_batches WHERE applied_at < now() - interval '7 days'")
+    os.remove(path)
+    return bool(fresh)
+
+
+def _settle(totals: dict, applied: bool):
+    """Переносит начисления партии из «ожидающих» в кэш счетов"""
+    for user_id, (name, delta) in totals.items():
+        entry = _pending.get(user_id)
+        if entry is not None:
+            entry[1] -= delta
+            if entry[1] == 0:
+                del _pending[user_id]
+        if not applied:
+            continue
+        if user_id in _scores:
+            _scores[user_id] += delta
+
+
+async def flush():
+    """Сбрасывает накопленные начисления в базу: одна партия — один запрос"""
+    async with _lock:
+        if _wal is not None and _wal.tell() > 0:
+            _rotate()
+        # Партии, не ушедшие раньше, идут первыми
+        for path in _batches():
+            totals = _read_batch(path)
+            try:
+                with metrics.timer("rep_flush"):
+                    applied = await _apply(path, totals)
+            except Exception as e:
+                # Файл партии остался на диске, повторим на следующем сбросе
+                logging.error(f"Reputation flush of {path} failed: {e}")
+                metrics.inc("rep_flush_failed")
+                return
+            _settle(totals, applied)
+            metrics.inc("rep_flushed_users", len(totals))
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(REP_FLUSH_INTERVAL)
+        await flush()
+
+
+async def start():
+    """Поднимает журнал прошлого запуска в память и запускает периодический сброс"""
+    global _task
+    if _task is not None:
+        return
+    paths = _batches()
+    if os.path.exists(REP_WAL_PATH):
+        paths.append(REP_WAL_PATH)
+    for path in paths:
+        for user_id, (name, delta) in _read_batch(path).items():
+            entry = _pending.setdefault(user_id, [name, 0])
+            entry[1] += delta
+    if _wal is None:
+        _open_wal()
+    await flush()
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    await flush()
+
+
+async def score(user_id: int) -> int:
+    """Счет пользователя с учетом еще не сброшенных начислений"""
+    if user_id not in _scores:
+        pool = await get_db()
+        async with pool.acquire() as conn:
+            _scores[user_id] = await conn.fetchval(
+                "SELECT score FROM reputation WHERE user_id = $1", user_id
+            ) or 0
+    return _scores[user_id] + _pending.get(user_id, (None, 0))[1]
+
+
+async def page(after_score: int = None, after_id: int = None, limit: int = 10) -> list[tuple[int, str, int]]:
+    """Страница рейтинга после (after_score, after_id) — по индексу, без OFFSET; без курсора — первая.
+    Все страницы читаются из базы, чтобы курсор и данные были из одного источника
+    (несброшенные начисления появятся через REP_FLUSH_INTERVAL)"""
+    pool = await get_db()
+    async with pool.acquire() as conn:
+        if after_score is None:
+            rows = await conn.fetch(
+                "SELECT user_id, name, score FROM reputation ORDER BY score DESC, user_id DESC LIMIT $1", limit
+            )
+        else:
+            rows = await conn.fetch("""
+                SELECT user_id, name, score FROM reputation
+                WHERE (score, user_id) < ($1, $2)
+                ORDER BY score DESC, user_id DESC
+                LIMIT $3
+            """, after_score, after_id, limit)
+    return [(row["user_id"], row["name"], row["score"]) for row in rows]
+
+
+def stats() -> dict:
+    return {"pending_users": len(_pending), "pending_delta": sum(v[1] for v in _pending.values())}
+
+
+metrics.register("reputation", stats)
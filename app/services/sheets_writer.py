@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+
+from app.services import google_api, metrics
+
+# Строки копятся и уходят в таблицу одним append_rows
+BATCH_SIZE = int(os.getenv("SHEETS_BATCH_SIZE", 20))
+FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", 2))
+MAX_BACKOFF = 60
+# После стольких 429/5xx подряд пачка сдается: строки остаются в outbox и уйдут позже
+MAX_ATTEMPTS = int(os.getenv("SHEETS_MAX_ATTEMPTS", 5))
+
+_queue = None
+_task = None
+_sheet_id = None
+_stopping = False
+_STOP = object()
+
+
+def start_writer(sheet_id: str):
+    """Запускает фоновую запись строк в таблицу"""
+    global _queue, _task, _sheet_id
+    if _task is not None:
+        return
+    _sheet_id = sheet_id
+    _queue = asyncio.Queue()
+    _task = asyncio.create_task(_run())
+    metrics.register("sheets_queue", lambda: {"pending": _queue.qsize()})
+
+
+def append_row(row: list) -> asyncio.Future:
+    """Ставит строку в очередь; future вернет True после записи в таблицу"""
+    future = asyncio.get_running_loop().create_future()
+    _queue.put_nowait((row, future))
+    return future
+
+
+async def stop_writer():
+    """Дописывает всё, что осталось в очереди, и останавливает запись"""
+    global _task, _stopping
+    if _task is None:
+        return
+    # Повторы при 429/5xx не должны задерживать выключение
+    _stopping = True
+    _queue.put_nowait(_STOP)
+    await _task
+    _task = None
+    _stopping = False
+
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await _queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        await _flush(batch)
+
+
+def _append(rows):
+    google_api.get_worksheet(_sheet_id).append_rows(rows)
+
+
+def _keys(rows) -> list:
+    # В строках персональные данные — в лог идет только ключ заявки (последний столбец)
+    return [row[-1] for row in rows]
+
+
+async def _flush(batch):
+    # gspread грузится лениво (см. google_api), к первой записи он уже импортирован
+    from gspread.exceptions import APIError
+
+    rows = [row for row, _ in batch]
+    delay = 1
+    ok = False
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with metrics.timer("sheets_append"):
+                await google_api.run(_append, rows)
+            metrics.inc("sheets_rows_written", len(rows))
+            ok = True
+            break
+        except APIError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status != 429 and not (status and status >= 500):
+                logging.error(f"Ошибка записи в таблицу ({len(rows)} строк): {e}; ключи: {_keys(rows)}")
+                break
+            metrics.inc("sheets_throttled")
+            if attempt == MAX_ATTEMPTS or _stopping:
+                logging.error(
+                    f"Таблица ответила {status}, пачка из {len(rows)} строк отложена (попыток: {attempt}); "
+                    f"ключи: {_keys(rows)}"
+                )
+                break
+            logging.warning(f"Таблица ответила {status}, повтор через {delay} сек.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+        except Exception as e:
+            logging.error(f"Ошибка записи в таблицу ({len(rows)} строк): {e}; ключи: {_keys(rows)}")
+            break
+
+    for _, future in batch:
+        if not future.done():
+            future.set_result(ok)
@@ -0,0 +1,36 @@
+import asyncio
+
+from app.services import metrics
+
+# key -> [task, число ожидающих]
+_inflight = {}
+
+
+async def do(key: str, produce):
+    """Одновременные вызовы с одним ключом разделяют один запуск produce()"""
+    flight = _inflight.get(key)
+    if flight is None:
+        task = asyncio.ensure_future(produce())
+        flight = _inflight[key] = [task, 0]
+        task.add_done_callback(lambda _: _inflight.pop(key, None) if _inflight.get(key) is flight else None)
+    else:
+        metrics.inc("singleflight_shared")
+
+    task = flight[0]
+    flight[1] += 1
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # Последний ожидающий ушел — запрос больше никому не нужен
+        if flight[1] == 1 and not task.done():
+            task.cancel()
+        raise
+    finally:
+        flight[1] -= 1
+
+
+def in_flight() -> int:
+    return len(_inflight)
+
+
+metrics.register("singleflight", lambda: {"in_flight": len(_inflight)})
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import web
+
+from app.services import metrics
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))
+# WEBHOOK_QUEUE=1 — отвечать Telegram сразу и обрабатывать из локальной очереди
+WEBHOOK_QUEUE = os.getenv("WEBHOOK_QUEUE", "0") == "1"
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", 1000))
+WEBHOOK_DRAIN_TIMEOUT = 25
+
+
+def secret_token(bot_token: str) -> str:
+    """Секрет вебхука: из WEBHOOK_SECRET или производный от токена бота"""
+    return os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+def setup_webhook(app: web.Application, dp: Dispatcher, bot: Bot):
+    """Вешает прием апдейтов на существующее aiohttp-приложение"""
+    secret = secret_token(bot.token)
+    slots = asyncio.Semaphore(WEBHOOK_WORKERS)
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_MAX) if WEBHOOK_QUEUE else None
+    workers = []
+
+    async def process(update: types.Update):
+        with metrics.timer("webhook_update"):
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+
+    async def worker():
+        while True:
+            update = await queue.get()
+            try:
+                await process(update)
+            finally:
+                queue.task_done()
+
+    async def handle_update(request: web.Request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+        metrics.inc("webhook_updates")
+
+        if queue is not None:
+            try:
+                queue.put_nowait(update)
+            except asyncio.QueueFull:
+                # Telegram повторит доставку позже
+                metrics.inc("webhook_rejected")
+                return web.Response(status=503)
+            return web.Response()
+
+        async with slots:
+            await process(update)
+        return web.Response()
+
+    async def on_startup(_):
+        if queue is not None:
+            workers.extend(asyncio.create_task(worker()) for _ in range(WEBHOOK_WORKERS))
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_WORKERS,
+            drop_pending_updates=False,
+        )
+        logging.info(f"Webhook mode: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+    async def on_shutdown(_):
+        if queue is not None:
+            # Дообрабатываем принятые апдейты — Telegram их больше не пришлет
+            try:
+                await asyncio.wait_for(queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.error(f"Не обработано апдейтов при остановке: {queue.qsize()}")
+            for task in workers:
+                task.cancel()
+
+    if queue is not None:
+        metrics.register("webhook_queue", lambda: {"pending": queue.qsize(), "workers": WEBHOOK_WORKERS})
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    setup_application(app, dp, bot=bot)
@@ -0,0 +1,94 @@
+"""Задержка запросов к инференсу: новая сессия на каждый запрос против общей.
+
+Поднимает локальный aiohttp-сервер вместо HF router и шлет в него одинаковые
+POST-запросы с картинкой — как hf_task_query. С --cert/--key сервер слушает
+по HTTPS, и в разницу попадает TLS-рукопожатие.
+
+    python bench/http_session.py --requests 200
+    python bench/http_session.py --cert cert.pem --key key.pem
+"""
+import argparse
+import asyncio
+import os
+import ssl
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import http  # noqa: E402
+
+PAYLOAD = os.urandom(200 * 1024)
+
+
+async def fake_inference(request):
+    await request.read()
+    return web.Response(body=b"\x89PNG" + b"\0" * 1024, content_type="image/png")
+
+
+async def one_request(session, url):
+    data = aiohttp.FormData()
+    data.add_field('image', PAYLOAD, filename='input.jpg', content_type='image/jpeg')
+    data.add_field('model', 'bench')
+    started = time.perf_counter()
+    async with session.post(url, data=data) as r:
+        await r.read()
+    return (time.perf_counter() - started) * 1000
+
+
+async def per_request_sessions(url, n):
+    # Как было раньше: свой коннектор и рукопожатие на каждый вызов
+    timings = []
+    for _ in range(n):
+        async with aiohttp.ClientSession(connector=http.make_connector()) as session:
+            timings.append(await one_request(session, url))
+    return timings
+
+
+async def shared_session(url, n):
+    session = await http.get_session()
+    timings = [await one_request(session, url) for _ in range(n)]
+    await http.close_session()
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:>12}: avg {statistics.mean(timings):6.2f} мс  p50 {statistics.median(timings):6.2f} мс  p95 {p95:6.2f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    args = parser.parse_args()
+
+    server_ssl = None
+    scheme = "http"
+    if args.cert and args.key:
+        server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_ssl.load_cert_chain(args.cert, args.key)
+        scheme = "https"
+
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app.router.add_post("/hf-inference/v1/{task}", fake_inference)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port, ssl_context=server_ssl).start()
+
+    url = f"{scheme}://127.0.0.1:{args.port}/hf-inference/v1/image-to-image"
+    print(f"{args.requests} запросов к {url}")
+    report("per-request", await per_request_sessions(url, args.requests))
+    report("shared", await shared_session(url, args.requests))
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""Сколько цикл событий стоит на месте при обработке одной картинки.
+
+old      — как было: декодирование ответа FLUX в PIL и PNG-пересжатие прямо в цикле
+finalize — image_pipeline.finalize(): перекодирование в IMAGE_FORMAT в пуле потоков
+passthru — формат провайдера подходит, байты отдаются как есть
+
+    python bench/image_encode_blocking.py --images 20 --format webp
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services import image_pipeline  # noqa: E402
+
+
+def sample_jpeg(size=1024) -> bytes:
+    # Шум + градиент, чтобы PNG не сжимался до пары килобайт
+    noise = Image.effect_noise((size, size), 64).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    out = io.BytesIO()
+    Image.blend(noise, gradient, 0.5).save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+async def measure(name, work, images):
+    """Максимальная и суммарная задержка тикера, который просыпается каждую 1 мс"""
+    lags = []
+    stop = False
+
+    async def ticker():
+        while not stop:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append((time.perf_counter() - started) * 1000 - 1)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    sizes = [len(await work()) for _ in range(images)]
+    elapsed = (time.perf_counter() - started) * 1000
+    stop = True
+    await task
+
+    blocked = sum(lag for lag in lags if lag > 2)
+    print(f"{name:>8}: max lag {max(lags):7.1f} мс  blocked {blocked / images:7.1f} мс/картинку  "
+          f"wall {elapsed / images:6.1f} мс/картинку  size {sizes[0] // 1024} КБ")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--format", default="webp", choices=["webp", "jpeg", "png"])
+    args = parser.parse_args()
+
+    source = sample_jpeg()
+    image_pipeline.IMAGE_FORMAT = args.format
+
+    async def old():
+        image = Image.open(io.BytesIO(source))
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+        return out.getvalue()
+
+    async def finalize():
+        return await image_pipeline.finalize(source)
+
+    async def passthru():
+        image_pipeline.IMAGE_FORMAT = "jpeg"
+        try:
+            return await image_pipeline.finalize(source)
+        finally:
+            image_pipeline.IMAGE_FORMAT = args.format
+
+    print(f"{args.images} картинок 1024x1024, исходник JPEG {len(source) // 1024} КБ, IMAGE_FORMAT={args.format}")
+    await measure("old", old, args.images)
+    await measure("finalize", finalize, args.images)
+    await measure("passthru", passthru, args.images)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
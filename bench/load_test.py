@@ -0,0 +1,366 @@
+"""Нагрузочный тест: синтетические пользователи через настоящие хэндлеры бота.
+
+Апдейты подаются прямо в dp.feed_update() (как из вебхука), поэтому работают
+все middleware, FSM-хранилище, очередь картинок, outbox и запись в таблицу.
+Внешние сервисы заменены:
+  Bot API, HF, Pollinations — заглушки bench/standins.py в отдельном процессе
+                              (Bot подключен через TelegramAPIServer);
+  Google Drive и Sheets      — подмена функций google_api на уровне сервиса.
+
+Пользователь проходит один из сценариев (доли задает --mix):
+  registration — /start ... скриншот оплаты (9 апдейтов)
+  gen          — /gen с уникальным промптом
+  style        — /style в ответ на фото
+  rep          — «+» в ответ на чужое сообщение
+
+    python bench/load_test.py --users 2000 --concurrency 200 --out baseline.json
+    python bench/load_test.py --users 2000 --concurrency 200 --baseline baseline.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standins  # noqa: E402
+
+TOKEN = "123456:bench"
+
+
+def configure(args, workdir: str, base_url: str):
+    """Окружение до импорта бота: все файлы — во временной папке, внешние адреса — заглушки"""
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "HUGGINGFACE_TOKEN": "bench",
+        "HF_ROUTER_URL": base_url,
+        "POLLINATIONS_URL": base_url,
+        "FSM_STORAGE": args.fsm_storage,
+        "FSM_SQLITE_PATH": os.path.join(workdir, "fsm.sqlite3"),
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.sqlite3"),
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "image_cache"),
+        "REP_WAL_PATH": os.path.join(workdir, "reputation.wal"),
+        "EVENTS_CONFIG": os.path.join(workdir, "events.json"),
+        "INVENTORY_PATH": os.path.join(workdir, "inventory.sqlite3"),
+        "BROADCAST_PATH": os.path.join(workdir, "broadcast.sqlite3"),
+        "SHEETS_FLUSH_INTERVAL": "0.5",
+    })
+    for name in ("ADMIN_ID", "DATABASE_URL", "WEBHOOK_URL"):
+        os.environ.pop(name, None)
+    # Те же даты, что у бота, но вместимость задает тест
+    with open(os.path.join(ROOT, "config", "events.json"), encoding="utf-8") as f:
+        events = json.load(f)
+    for date in events["dates"]:
+        for slot in date["slots"]:
+            slot["capacity"] = args.capacity
+    with open(os.environ["EVENTS_CONFIG"], "w", encoding="utf-8") as f:
+        json.dump(events, f, ensure_ascii=False)
+
+
+def fake_google(latency: float, error_rate: float):
+    """Drive и Sheets на уровне app.services.google_api: задержка в потоке пула Google"""
+    from app.services import google_api
+
+    calls = {"uploads": 0, "rows": 0}
+    lock = threading.Lock()
+
+    def pause():
+        time.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < error_rate:
+            raise RuntimeError("injected Google error")
+
+    class Sheet:
+        def append_rows(self, rows, **kwargs):
+            pause()
+            with lock:
+                calls["rows"] += len(rows)
+
+    def upload_file(stream, name, folder_id, mimetype="image/jpeg", properties=None):
+        stream.seek(0)
+        while stream.read(google_api.UPLOAD_CHUNK):
+            pass
+        pause()
+        with lock:
+            calls["uploads"] += 1
+            n = calls["uploads"]
+        return {"id": str(n), "webViewLink": f"https://drive.local/{n}"}
+
+    google_api.init_google = lambda: None
+    google_api.get_worksheet = lambda sheet_id: Sheet()
+    google_api.find_file = lambda *args: pause()
+    google_api.find_row = lambda *args: pause()
+    google_api.upload_file = upload_file
+    return calls
+
+
+class Users:
+    """Синтетические апдейты Telegram"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}"}
+
+    def message(self, uid: int, text: str = None, photo: bool = False, reply_to: dict = None) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": self._user(uid),
+        }
+        if text is not None:
+            message["text"] = text
+        if photo:
+            message["photo"] = [
+                {"file_id": f"ph{uid}_{size}", "file_unique_id": f"u{uid}_{size}",
+                 "width": size, "height": size, "file_size": size * 100}
+                for size in (90, 320, 800, 1280)
+            ]
+        if reply_to is not None:
+            message["reply_to_message"] = reply_to
+        return message
+
+    def update(self, **payload):
+        from aiogram.types import Update
+        return Update.model_validate({"update_id": next(self.update_ids), **payload}, context={"bot": self.bot})
+
+    def callback(self, uid: int, data: str) -> dict:
+        bot_message = self.message(uid, text="summary")
+        bot_message["from"] = {"id": 1, "is_bot": True, "first_name": "bench"}
+        return {"id": str(next(self.message_ids)), "from": self._user(uid),
+                "chat_instance": str(uid), "data": data, "message": bot_message}
+
+    def registration(self, uid: int, catalog: dict):
+        date = random.choice(list(catalog))
+        steps = [
+            ("start", "/start"),
+            ("begin", "🚀 Начать регистрацию"),
+            ("name", f"Пользователь {uid}"),
+            ("contact", f"@user{uid}"),
+            ("date", date),
+            ("time", random.choice(catalog[date])),
+            ("allergies", "Нет"),
+        ]
+        for step, text in steps:
+            yield step, self.update(message=self.message(uid, text))
+        yield "confirm", self.update(callback_query=self.callback(uid, "confirm_ok"))
+        yield "payment", self.update(message=self.message(uid, photo=True))
+
+    def gen(self, uid: int):
+        yield "gen", self.update(message=self.message(uid, f"/gen bench city {uid}"))
+
+    def style(self, uid: int):
+        yield "style", self.update(message=self.message(uid, "/style аниме", reply_to=self.message(uid, photo=True)))
+
+    def rep(self, uid: int):
+        yield "rep", self.update(message=self.message(uid, "+", reply_to=self.message(uid + 1, "привет")))
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(len(values) * q))]  # noqa: E731
+    return {"count": len(values), "p50": round(pick(0.5), 1), "p95": round(pick(0.95), 1),
+            "p99": round(pick(0.99), 1), "max": round(values[-1], 1)}
+
+
+async def watch_loop(samples: list, stop: asyncio.Event, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, (time.perf_counter() - started - interval) * 1000))
+
+
+def wait_port(port: int, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"заглушки не поднялись на порту {port}")
+
+
+async def run(args) -> dict:
+    import logging
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import main as bot_main
+    from app.handlers.base import base_router
+    from app.services import http, inventory, jobs, metrics, outbox, sheets_writer
+
+    logging.getLogger().setLevel(logging.WARNING)
+    google_calls = fake_google(args.google_latency_ms / 1000, args.error_rate)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    # Хэндлеры регистрации обращаются к глобальному bot
+    bot_main.bot = bot
+    dp = bot_main.dp
+    dp.include_router(base_router)
+
+    outbox.init_outbox()
+    await inventory.start()
+    catalog = inventory.catalog()
+    sheets_writer.start_writer(bot_main.SHEET_ID)
+    outbox.start_drainer(bot_main.upload_to_drive_and_save_row)
+
+    users = Users(bot)
+    weights = dict(item.split("=") for item in args.mix.split(","))
+    kinds = random.choices(list(weights), [float(w) for w in weights.values()], k=args.users)
+    latencies = {}
+    errors = {}
+    lag = []
+    stop = asyncio.Event()
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def user(n: int, kind: str):
+        uid = 10_000_000 + n * 2
+        if kind == "registration":
+            updates = users.registration(uid, catalog)
+        else:
+            updates = getattr(users, kind)(uid)
+        async with slots:
+            for step, update in updates:
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                latencies.setdefault(step, []).append((time.perf_counter() - started) * 1000)
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000 * random.uniform(0.5, 1.5))
+
+    lag_task = asyncio.create_task(watch_loop(lag, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(user(n, kind) for n, kind in enumerate(kinds)))
+    wall = time.perf_counter() - started
+
+    # Фоновая часть: картинки в очереди и выгрузка заявок в Google
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline:
+        image_stats = jobs.stats()
+        if not image_stats["running"] and not sum(image_stats["queued"].values()) and not outbox.depth():
+            break
+        await asyncio.sleep(0.2)
+    drained = time.perf_counter() - started
+    stop.set()
+    await lag_task
+
+    snapshot = metrics.snapshot()
+    background = {name: snapshot["timings"][name] for name in sorted(snapshot["timings"])
+                  if name.startswith(("job{", "outbox_", "sheets_append", "provider{", "inference"))}
+    result = {
+        "params": vars(args),
+        "updates": sum(len(v) for v in latencies.values()),
+        "wall_sec": round(wall, 2),
+        "drain_sec": round(drained, 2),
+        "throughput": round(sum(len(v) for v in latencies.values()) / wall, 1),
+        "latency_ms": {"all": percentiles([x for v in latencies.values() for x in v]),
+                       **{step: percentiles(v) for step, v in sorted(latencies.items())}},
+        "loop_lag_ms": percentiles(lag),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": errors,
+        "outbox_left": outbox.depth(),
+        "google": google_calls,
+        "background_ms": background,
+    }
+
+    await jobs.stop_workers()
+    await outbox.stop_drainer()
+    await inventory.stop()
+    await sheets_writer.stop_writer()
+    await dp.storage.close()
+    await http.close_session()
+    await bot.session.close()
+    return result
+
+
+def report(result: dict, baseline: dict = None):
+    def delta(path):
+        if not baseline:
+            return ""
+        now, before = result, baseline
+        for key in path:
+            now, before = now.get(key, {}), before.get(key, {}) if isinstance(before, dict) else {}
+        if not isinstance(before, (int, float)) or not before:
+            return ""
+        return f" ({(now - before) / before * 100:+.0f}%)"
+
+    print(f"апдейтов {result['updates']} за {result['wall_sec']} с — "
+          f"{result['throughput']} апд/с{delta(['throughput'])}; фон дочищен за {result['drain_sec']} с")
+    print(f"{'шаг':>12} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}   (мс)")
+    for step, stats in result["latency_ms"].items():
+        if stats:
+            print(f"{step:>12} {stats['count']:>6} {stats['p50']:>8} {stats['p95']:>8} {stats['p99']:>8} "
+                  f"{stats['max']:>8}{delta(['latency_ms', step, 'p95'])}")
+    lag = result["loop_lag_ms"]
+    print(f"лаг цикла событий: p50 {lag['p50']} мс, p99 {lag['p99']} мс, max {lag['max']} мс"
+          f"{delta(['loop_lag_ms', 'p99'])}")
+    print(f"пиковый RSS: {result['peak_rss_mb']} МБ{delta(['peak_rss_mb'])}")
+    print(f"ошибки: {result['errors'] or 'нет'}; не выгружено заявок: {result['outbox_left']}")
+    for name, stats in result["background_ms"].items():
+        print(f"  {name}: n={stats['count']} p50 {stats['p50_ms']} мс p95 {stats['p95_ms']} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100, help="пользователей одновременно")
+    parser.add_argument("--mix", default="registration=0.5,gen=0.15,style=0.1,rep=0.25")
+    parser.add_argument("--think-ms", type=float, default=0, help="пауза пользователя между шагами")
+    parser.add_argument("--tg-latency-ms", type=float, default=40)
+    parser.add_argument("--hf-latency-ms", type=float, default=1500)
+    parser.add_argument("--google-latency-ms", type=float, default=300)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ошибок во всех заглушках")
+    parser.add_argument("--capacity", type=int, default=100_000, help="мест в каждом слоте")
+    parser.add_argument("--fsm-storage", default="sqlite", choices=["sqlite", "memory"])
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="сохранить результат в JSON")
+    parser.add_argument("--baseline", help="сравнить с сохраненным результатом")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server = multiprocessing.Process(
+        target=standins.serve, args=(args.port, args.tg_latency_ms, args.hf_latency_ms, args.error_rate), daemon=True
+    )
+    server.start()
+    try:
+        wait_port(args.port)
+        with tempfile.TemporaryDirectory() as workdir:
+            configure(args, workdir, f"http://127.0.0.1:{args.port}")
+            result = asyncio.run(run(args))
+    finally:
+        server.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Пиковый RSS при одновременной выгрузке чеков.
+
+Сравнивает старую схему (download -> read() -> BytesIO -> загрузка целиком)
+с потоковой (download кусками в SpooledTemporaryFile -> загрузка кусками).
+Telegram и Drive заменены генератором и читателем с той же нарезкой.
+
+    python bench/receipt_upload_rss.py --receipts 50 --size-mb 3
+"""
+import argparse
+import asyncio
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+DOWNLOAD_CHUNK = 64 * 1024
+UPLOAD_CHUNK = 4 * 256 * 1024   # как google_api.UPLOAD_CHUNK
+SPOOL_MAX = 1024 * 1024         # как RECEIPT_SPOOL_MAX в main.py
+
+
+async def telegram_stream(size):
+    """Имитация скачивания файла с серверов Telegram"""
+    sent = 0
+    while sent < size:
+        chunk = os.urandom(min(DOWNLOAD_CHUNK, size - sent))
+        sent += len(chunk)
+        yield chunk
+        await asyncio.sleep(0)
+
+
+def drive_upload(fd, chunksize):
+    """Имитация MediaIoBaseUpload: читает файл кусками по chunksize"""
+    fd.seek(0)
+    total = 0
+    while True:
+        chunk = fd.read(chunksize)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+
+async def buffered_receipt(size):
+    downloaded = io.BytesIO()
+    async for chunk in telegram_stream(size):
+        downloaded.write(chunk)
+    downloaded.seek(0)
+    content = downloaded.read()
+    # По умолчанию MediaIoBaseUpload берет кусок в 100 МБ, то есть весь файл
+    return await asyncio.to_thread(drive_upload, io.BytesIO(content), 100 * 1024 * 1024)
+
+
+async def streamed_receipt(size):
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX) as receipt:
+        async for chunk in telegram_stream(size):
+            receipt.write(chunk)
+        return await asyncio.to_thread(drive_upload, receipt, UPLOAD_CHUNK)
+
+
+async def run(mode, receipts, size):
+    handler = buffered_receipt if mode == "buffered" else streamed_receipt
+    results = await asyncio.gather(*(handler(size) for _ in range(receipts)))
+    assert all(r == size for r in results)
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает КБ, macOS — байты
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--receipts", type=int, default=50)
+    parser.add_argument("--size-mb", type=float, default=3)
+    parser.add_argument("--mode", choices=["buffered", "streamed"])
+    args = parser.parse_args()
+    size = int(args.size_mb * 1024 * 1024)
+
+    if args.mode:
+        asyncio.run(run(args.mode, args.receipts, size))
+        print(f"{peak_rss_mb():.1f}")
+        return
+
+    # Каждый режим в отдельном процессе, чтобы пики не смешивались
+    print(f"{args.receipts} чеков по {args.size_mb} МБ")
+    for mode in ("buffered", "streamed"):
+        out = subprocess.run(
+            [sys.executable, __file__, "--mode", mode,
+             "--receipts", str(args.receipts), "--size-mb", str(args.size_mb)],
+            check=True, capture_output=True, text=True
+        ).stdout.strip()
+        print(f"{mode:>9}: пиковый RSS {out} МБ")
+
+
+if __name__ == "__main__":
+    main()
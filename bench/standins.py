@@ -0,0 +1,139 @@
+"""Локальные заглушки внешних сервисов для нагрузочного теста.
+
+Один aiohttp-сервер отвечает за:
+  /bot<token>/<method>        — Bot API (sendMessage, editMessageText, getFile, ...)
+  /file/bot<token>/<path>     — скачивание файлов Telegram
+  /hf-inference/...           — роутер Hugging Face
+  /prompt/<text>              — Pollinations
+
+Задержка каждого ответа — latency * U(0.5, 1.5); с вероятностью error-rate
+отвечает ошибкой (500 для Bot API, 503 для HF и Pollinations).
+
+    python bench/standins.py --port 8089 --tg-latency-ms 40 --hf-latency-ms 1500 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+from PIL import Image
+
+RESULT_METHODS = {
+    "deletemessage", "answercallbackquery", "setwebhook", "deletewebhook", "setmycommands",
+}
+
+
+def sample_image(size=1024, fmt="JPEG") -> bytes:
+    noise = Image.effect_noise((size, size), 48).convert("RGB")
+    out = io.BytesIO()
+    noise.save(out, format=fmt, quality=85)
+    return out.getvalue()
+
+
+class StandIns:
+    def __init__(self, tg_latency: float, hf_latency: float, error_rate: float):
+        self.tg_latency = tg_latency
+        self.hf_latency = hf_latency
+        self.error_rate = error_rate
+        self.message_ids = itertools.count(1_000_000)
+        self.file_ids = itertools.count(1)
+        self.photo = sample_image()
+        self.result = sample_image(fmt="PNG")
+        self.calls = {}
+
+    async def _delay(self, latency):
+        if latency:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+
+    def _failed(self) -> bool:
+        return random.random() < self.error_rate
+
+    def _message(self, chat_id, **fields) -> dict:
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "group"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            **fields,
+        }
+
+    def _file(self, prefix: str) -> dict:
+        n = next(self.file_ids)
+        return {"file_id": f"{prefix}{n}", "file_unique_id": f"u{prefix}{n}", "file_size": len(self.result)}
+
+    async def bot_api(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}
+        await self._delay(self.tg_latency)
+        if self._failed():
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error: injected"}, status=500
+            )
+
+        chat_id = params.get("chat_id", 1)
+        if method in RESULT_METHODS:
+            result = True
+        elif method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getfile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "f", "file_size": len(self.photo),
+                      "file_path": f"photos/{params.get('file_id')}.jpg"}
+        elif method == "sendphoto":
+            result = self._message(chat_id, photo=[{**self._file("p"), "width": 1024, "height": 1024}])
+        elif method == "senddocument":
+            result = self._message(chat_id, document=self._file("d"))
+        elif method == "copymessage":
+            result = {"message_id": next(self.message_ids)}
+        else:
+            # sendMessage, editMessageText и прочее, что возвращает Message
+            result = self._message(chat_id, text=params.get("text", ""))
+        return web.json_response({"ok": True, "result": result})
+
+    async def bot_file(self, request: web.Request):
+        await self._delay(self.tg_latency)
+        # Хвост после JPEG декодеры игнорируют, а кэш картинок видит разные файлы
+        return web.Response(body=self.photo + request.match_info["path"].encode(), content_type="image/jpeg")
+
+    async def inference(self, request: web.Request):
+        await request.read()
+        await self._delay(self.hf_latency)
+        if self._failed():
+            return web.Response(status=503, text="Model is loading")
+        return web.Response(body=self.result, content_type="image/png")
+
+    async def stats(self, request: web.Request):
+        return web.json_response(self.calls)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.bot_file)
+        app.router.add_post("/hf-inference/{path:.+}", self.inference)
+        app.router.add_get("/prompt/{prompt:.+}", self.inference)
+        app.router.add_get("/_stats", self.stats)
+        return app
+
+
+def serve(port: int, tg_latency_ms: float, hf_latency_ms: float, error_rate: float):
+    stand_ins = StandIns(tg_latency_ms / 1000, hf_latency_ms / 1000, error_rate)
+    web.run_app(stand_ins.app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--tg-latency-ms", type=float, default=40)
+    parser.add_argument("--hf-latency-ms", type=float, default=1500)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    print(json.dumps(vars(args)))
+    serve(args.port, args.tg_latency_ms, args.hf_latency_ms, args.error_rate)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,11 +8,34 @@ load_dotenv()
 class Config:
     bot_token: str
     admin_ids: list[int]
+    # Пул asyncpg: на бесплатном Postgres мало соединений, держим их немного
+    db_pool_min_size: int = 1
+    db_pool_max_size: int = 10
+    db_max_inactive_lifetime: float = 300.0
+    db_statement_cache_size: int = 100
+    db_command_timeout: float = 30.0
+    # Таймаут подключения: у asyncpg по умолчанию 60 сек
+    db_connect_timeout: float = 10.0
 
 def load_config() -> Config:
     return Config(
         bot_token=os.getenv("BOT_TOKEN"),
-        admin_ids=[int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
+        admin_ids=[int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id],
+        db_pool_min_size=int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+        db_pool_max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+        db_max_inactive_lifetime=float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300)),
+        db_statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100)),
+        db_command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", 30)),
+        db_connect_timeout=float(os.getenv("DB_CONNECT_TIMEOUT", 10)),
     )
 
-config = load_config()
\ No newline at end of file
+_config = None
+
+def __getattr__(name):
+    # config читается при первом обращении, а не при импорте модуля
+    global _config
+    if name == "config":
+        if _config is None:
+            _config = load_config()
+        return _config
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
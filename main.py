@@ -1,17 +1,14 @@
 import asyncio
 import logging
 import os
+import signal
 import sys
 import datetime
-import io
-import json
-import base64
+import tempfile
+import time
 
-# Библиотеки Google
-import gspread
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+# Точка отсчета для разбивки времени запуска — до тяжелых импортов (aiogram и пр.)
+BOOT_STARTED = time.perf_counter()
 
 # Aiogram 3.x
 from aiogram import Bot, Dispatcher, types, F
@@ -25,6 +22,13 @@ from aiogram.types import (
 )
 from aiohttp import web
 
+from app.middlewares.metrics import MetricsMiddleware
+from app.services import broadcast, google_api, inventory, metrics, outbox, sheets_writer, webhook
+from app.services.fsm_storage import create_storage
+
+metrics.boot(BOOT_STARTED)
+metrics.startup_phase("imports")
+
 # --- КОНФИГУРАЦИЯ ---
 TOKEN = os.getenv("BOT_TOKEN") 
 ADMIN_ID = os.getenv("ADMIN_ID") 
@@ -33,24 +37,26 @@ PORT = int(os.getenv("PORT", 8080))
 OFFER_LINK = "https://disk.yandex.ru/i/965-_UGNIPkaaQ"
 DRIVE_FOLDER_ID = "1aPzxYWdh085ZjQnr2KXs3O_HMCCWpfhn"
 SHEET_ID = "19vNVslHJEnkZCumR9e_sSc4M-YtqFWj6cLIwxojEZY0" 
+# Чеки до этого размера держим в памяти, крупнее — во временном файле
+RECEIPT_SPOOL_MAX = int(os.getenv("RECEIPT_SPOOL_MAX", 1024 * 1024))
+# /healthz отвечает 503, если цикл событий занят дольше этого
+HEALTH_MAX_LOOP_LAG_MS = float(os.getenv("HEALTH_MAX_LOOP_LAG_MS", 1000))
 
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
-logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+dp = Dispatcher(storage=create_storage())
+# Время и ошибки каждого хэндлера и шага регистрации — на /metrics
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
 
-# Конфигурация дат и соответствующего времени
-DATES_CONFIG = {
-    "📅 21 янв (ср) | 📍 Нагаево": "21 января (ср) - Нагаево",
-    "📅 23 янв (пт) | 📍 Бакалинская 25": "23 января (пт) - Бакалинская 25",
-    "📅 25 янв (вс) | 📍 Бакалинская 25": "25 января (вс) - Бакалинская 25"
-}
+@dp.update.outer_middleware()
+async def mark_first_update(handler, event, data):
+    # Время до первого апдейта после перезапуска — главный показатель холодного старта
+    metrics.startup_phase("first_update")
+    return await handler(event, data)
+
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
-# Словарь с доступным временем для каждой даты
-TIMES_BY_DATE = {
-    "📅 21 янв (ср) | 📍 Нагаево": ["🕙 20:00"],
-    "📅 23 янв (пт) | 📍 Бакалинская 25": ["🕙 10:00", "🕖 19:00"],
-    "📅 25 янв (вс) | 📍 Бакалинская 25": ["🕙 10:00", "🕖 19:00"]
-}
+# Даты, время и количество мест — в config/events.json (app/services/inventory.py)
 
 class Registration(StatesGroup):
     waiting_for_name = State()
@@ -63,66 +69,73 @@ class Registration(StatesGroup):
 
 # --- ФУНКЦИИ GOOGLE ---
 
-async def upload_to_drive_and_save_row(data, photo_file_id):
-    try:
-        file_info = await bot.get_file(photo_file_id)
-        file_content_io = await bot.download_file(file_info.file_path)
-        content_bytes = file_content_io.read()
-
-        def _sync_logic(content):
-            encoded_key = os.getenv("GOOGLE_JSON_KEY", "").strip()
-            decoded_key = base64.b64decode(encoded_key).decode('utf-8')
-            key_data = json.loads(decoded_key)
-            
-            if "private_key" in key_data:
-                key_data["private_key"] = key_data["private_key"].replace("\\n", "\n")
-            
-            SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
-            creds = service_account.Credentials.from_service_account_info(key_data, scopes=SCOPES)
-            
-            drive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
-            file_metadata = {
-                'name': f"Чек_{data['name']}_{datetime.datetime.now().strftime('%d_%m')}.jpg",
-                'parents': [DRIVE_FOLDER_ID]
-            }
-            media = MediaIoBaseUpload(io.BytesIO(content), mimetype='image/jpeg', resumable=True)
-            drive_file = drive_service.files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
-            
-            client = gspread.authorize(creds)
-            sheet = client.open_by_key(SHEET_ID).sheet1
-            
-            row = [
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                data.get('name'), data.get('contact'),
-                data.get('selected_date'), data.get('selected_time'),
-                data.get('allergies'), drive_file.get('webViewLink')
-            ]
-            sheet.append_row(row)
-            return True
-
-        return await asyncio.to_thread(_sync_logic, content_bytes)
-    except Exception as e:
-        logging.error(f"Ошибка Google Services: {e}")
-        return False
+async def upload_to_drive_and_save_row(entry):
+    """Выгружает заявку из outbox: чек в Drive, строку в таблицу. При ошибке бросает исключение"""
+    data = entry["data"]
+    created = datetime.datetime.fromtimestamp(entry["created_at"])
+    drive_link = entry["drive_link"]
+
+    if drive_link is None:
+        file_info = await bot.get_file(entry["file_id"])
+
+        def _sync_logic(receipt):
+            with google_api.timed("google_sync"), metrics.timer("drive_upload"):
+                # Прошлая попытка могла упасть или прерваться уже после загрузки чека
+                if entry["attempts"]:
+                    existing = google_api.find_file(DRIVE_FOLDER_ID, "outbox_key", entry["key"])
+                    if existing:
+                        return existing
+                return google_api.upload_file(
+                    receipt,
+                    f"Чек_{data['name']}_{created.strftime('%d_%m')}.jpg",
+                    DRIVE_FOLDER_ID,
+                    properties={"outbox_key": entry["key"]}
+                )
+
+        # Чек пишется кусками прямо в spool-файл и оттуда же кусками уходит в Drive
+        with tempfile.SpooledTemporaryFile(max_size=RECEIPT_SPOOL_MAX) as receipt:
+            with metrics.timer("telegram_download"):
+                await bot.download_file(file_info.file_path, destination=receipt, chunk_size=64 * 1024)
+            drive_file = await google_api.run(_sync_logic, receipt)
+        drive_link = drive_file.get('webViewLink')
+        outbox.mark_uploaded(entry["id"], drive_link)
+
+    row = [
+        created.strftime("%Y-%m-%d %H:%M:%S"),
+        data.get('name'), data.get('contact'),
+        inventory.date_title(data.get('selected_date')), data.get('selected_time'),
+        data.get('allergies'), drive_link, entry["key"]
+    ]
+    # append_rows мог пройти, а ответ потеряться — тогда строка с этим ключом уже есть
+    if entry["attempts"] and await google_api.run(google_api.find_row, SHEET_ID, len(row), entry["key"]):
+        return
+    if not await sheets_writer.append_row(row):
+        raise RuntimeError("строка не записана в таблицу")
 
 # --- КЛАВИАТУРЫ ---
 
+START_KB = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🚀 Начать регистрацию")]], resize_keyboard=True)
+SOLD_OUT_TEXT = "😔 Все места уже заняты. Следите за новостями — мы сообщим о новых датах."
+
 def get_start_kb():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🚀 Начать регистрацию")]], resize_keyboard=True)
+    return START_KB
 
+# Клавиатуры дат и времени собираются один раз и пересобираются, только когда
+# какой-то слот распродан или снова освободился
 def get_dates_kb():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=d)] for d in DATES_CONFIG.keys()], resize_keyboard=True)
+    return inventory.dates_keyboard()
 
-def get_times_kb(times_list):
-    buttons = [[KeyboardButton(text=t)] for t in times_list]
-    buttons.append([KeyboardButton(text="⬅️ Назад к датам")])
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+def get_times_kb(date):
+    return inventory.times_keyboard(date)
 
 # --- ХЭНДЛЕРЫ ---
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     await state.clear()
+    await inventory.release(message.from_user.id)
+    # Этот /start перекрывает /start из app/handlers/base.py — подписку на мотивацию делаем здесь
+    broadcast.subscribe(message.chat.id, broadcast.FAMILY)
     welcome_text = (
         "✨ **МИСТЕРИЯ «СТАЛЬ • СОЛЬ • ОГОНЬ • ШАМАН и МАГИЯ РОДА»**\n"
         "━━━━━━━━━━━━━━━━━━\n"
@@ -131,6 +144,41 @@ async def cmd_start(message: types.Message, state: FSMContext):
     )
     await message.answer(welcome_text, reply_markup=get_start_kb(), parse_mode="Markdown")
 
+def is_admin(message: types.Message) -> bool:
+    return bool(ADMIN_ID) and str(message.from_user.id) == str(ADMIN_ID)
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    """Рассылка всем, кто прошел регистрацию: /broadcast текст"""
+    if not is_admin(message):
+        return
+    text = message.text.replace("/broadcast", "", 1).strip()
+    if not text:
+        return await message.answer("Текст рассылки: /broadcast Напоминаем, что встреча завтра в 19:00")
+    broadcast_id = broadcast.create("registrants", text, notify_chat=message.chat.id)
+    await message.answer(f"📣 Рассылка #{broadcast_id} запущена, пришлю отчет по завершении")
+
+@dp.message(Command("remind"))
+async def cmd_remind(message: types.Message):
+    """Отложенная рассылка участникам: /remind 20.01 18:00 текст"""
+    if not is_admin(message):
+        return
+    parts = message.text.split(maxsplit=3)
+    try:
+        now = datetime.datetime.now(broadcast.BOT_TZ)
+        run_at = datetime.datetime.strptime(f"{parts[1]}.{now.year} {parts[2]}", "%d.%m.%Y %H:%M")
+        run_at = run_at.replace(tzinfo=broadcast.BOT_TZ)
+        # День уже прошел в этом году (05.01 в декабре) — значит, следующий год
+        if run_at.date() < now.date():
+            run_at = run_at.replace(year=now.year + 1)
+        text = parts[3]
+    except (IndexError, ValueError):
+        return await message.answer("Формат: /remind 20.01 18:00 текст напоминания")
+    if run_at <= now:
+        return await message.answer("⚠️ Это время уже прошло")
+    broadcast_id = broadcast.create("registrants", text, run_at=run_at.timestamp(), notify_chat=message.chat.id)
+    await message.answer(f"⏰ Напоминание #{broadcast_id} уйдет {run_at:%d.%m в %H:%M}")
+
 @dp.message(F.text == "🚀 Начать регистрацию")
 async def start_form(message: types.Message, state: FSMContext):
     await message.answer("Шаг 1: Введите ваше **ФИО**:", reply_markup=ReplyKeyboardRemove(), parse_mode="Markdown")
@@ -145,37 +193,56 @@ async def process_name(message: types.Message, state: FSMContext):
 @dp.message(Registration.waiting_for_contact, F.text)
 async def process_contact(message: types.Message, state: FSMContext):
     await state.update_data(contact=message.text)
-    await message.answer("Шаг 3: Выберите **дату** нашей встречи:", reply_markup=get_dates_kb())
+    dates_kb = get_dates_kb()
+    if dates_kb is None:
+        await state.clear()
+        return await message.answer(SOLD_OUT_TEXT, reply_markup=ReplyKeyboardRemove())
+    await message.answer("Шаг 3: Выберите **дату** нашей встречи:", reply_markup=dates_kb)
     await state.set_state(Registration.waiting_for_date)
 
 @dp.message(Registration.waiting_for_date, F.text)
 async def process_date(message: types.Message, state: FSMContext):
-    if message.text not in DATES_CONFIG:
+    if not inventory.is_date(message.text):
         return
+    if not inventory.open_times(message.text):
+        dates_kb = get_dates_kb()
+        if dates_kb is None:
+            await state.clear()
+            return await message.answer(SOLD_OUT_TEXT, reply_markup=ReplyKeyboardRemove())
+        return await message.answer("😔 На эту дату мест уже нет, выберите другую:", reply_markup=dates_kb)
     
     await state.update_data(selected_date=message.text)
-    available_times = TIMES_BY_DATE.get(message.text, [])
     
     await message.answer(
         "Шаг 4: Выберите удобное **время**:", 
-        reply_markup=get_times_kb(available_times),
+        reply_markup=get_times_kb(message.text),
         parse_mode="Markdown"
     )
     await state.set_state(Registration.waiting_for_time)
 
 @dp.message(Registration.waiting_for_time, F.text)
 async def process_time(message: types.Message, state: FSMContext):
-    if message.text == "⬅️ Назад к датам":
-        await message.answer("Шаг 3: Выберите **дату**:", reply_markup=get_dates_kb())
+    if message.text == inventory.BACK_TO_DATES:
+        await inventory.release(message.from_user.id)
+        dates_kb = get_dates_kb()
+        if dates_kb is None:
+            await state.clear()
+            return await message.answer(SOLD_OUT_TEXT, reply_markup=ReplyKeyboardRemove())
+        await message.answer("Шаг 3: Выберите **дату**:", reply_markup=dates_kb)
         await state.set_state(Registration.waiting_for_date)
         return
     
     user_data = await state.get_data()
     selected_date = user_data.get('selected_date')
-    valid_times = TIMES_BY_DATE.get(selected_date, [])
 
-    if message.text not in valid_times:
+    if inventory.get_slot(selected_date, message.text) is None:
         return
+    # Место держится за пользователем, пока он оплачивает
+    if not await inventory.hold(message.from_user.id, selected_date, message.text):
+        return await message.answer(
+            "😔 На это время места только что закончились, выберите другое:",
+            reply_markup=get_times_kb(selected_date)
+        )
 
     await state.update_data(selected_time=message.text)
     await message.answer("Шаг 5: Есть ли у вас **аллергия** на травы или эфирные масла? (Если нет — напишите «Нет»)", reply_markup=ReplyKeyboardRemove())
@@ -216,6 +283,7 @@ async def process_confirm(callback: types.CallbackQuery, state: FSMContext):
 @dp.message(Registration.waiting_for_payment_proof, F.photo)
 async def process_payment_proof(message: types.Message, state: FSMContext):
     data = await state.get_data()
+    seat_ok = await inventory.confirm(message.from_user.id, data.get('selected_date'), data.get('selected_time'))
     
     if ADMIN_ID:
         try:
@@ -224,17 +292,23 @@ async def process_payment_proof(message: types.Message, state: FSMContext):
                 f"━━━━━━━━━━━━━━━━━━\n"
                 f"👤 **ФИО:** {data.get('name')}\n"
                 f"📞 **Связь:** {data.get('contact')}\n"
-                f"🗓 **Дата/Время:** {data.get('selected_date')} {data.get('selected_time')}\n"
+                f"🗓 **Дата/Время:** {inventory.date_title(data.get('selected_date'))} {data.get('selected_time')}\n"
                 f"⚠️ **Аллергии:** {data.get('allergies')}\n"
                 f"🆔 ID: `{message.from_user.id}`\n"
             )
+            if not seat_ok:
+                report += "⚠️ Бронь истекла, а мест уже нет — оплата сверх вместимости\n"
             await bot.send_message(ADMIN_ID, report, parse_mode="Markdown")
             await message.copy_to(ADMIN_ID)
         except Exception as e:
             logging.error(f"Ошибка уведомления админа: {e}")
 
     wait_msg = await message.answer("⌛ Сохраняю ваше место в сакральном списке...")
-    await upload_to_drive_and_save_row(data, message.photo[-1].file_id)
+    # chat_id нужен для напоминаний и рассылок участникам
+    data["chat_id"] = message.chat.id
+    broadcast.subscribe(message.chat.id, "registrants")
+    # Заявка сначала ложится в локальную очередь, в Google она уйдет в фоне
+    position = outbox.put(f"{message.chat.id}:{message.message_id}", data, message.photo[-1].file_id)
     
     # ПРАВКА: Исправлена синтаксическая ошибка в строке (недопустимый перенос без кавычек)
     final_text = (
@@ -243,19 +317,88 @@ async def process_payment_proof(message: types.Message, state: FSMContext):
         "Не забудьте взять с собой удобную одежду, теплые носки и плед. "
         "По желанию — что-то к чаю. До встречи на Мистерии ✨"
     )
+    if position > 1:
+        final_text += f"\n\n📨 Чек в очереди на сохранение: вы №{position}"
     await wait_msg.edit_text(final_text)
     await state.clear()
 
 async def handle(request): return web.Response(text="OK")
 
+async def handle_stats(request): return web.json_response(metrics.snapshot())
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def handle_health(request):
+    """Живы ли цикл событий и база: 200 — да, 503 — нет"""
+    lag = metrics.loop_lag_ms()
+    checks = {"loop_lag_ms": round(lag, 1), "loop": lag < HEALTH_MAX_LOOP_LAG_MS}
+    if os.getenv("DATABASE_URL"):
+        from app.services import db
+        # Пул поднимается в фоне с повторами; проверка только пингует его
+        try:
+            if db.pool is None:
+                db.start_connecting()
+                raise RuntimeError("pool is not initialized yet")
+            async with db.pool.acquire(timeout=2) as conn:
+                await conn.fetchval("SELECT 1", timeout=2)
+            checks["db"] = True
+        except Exception as e:
+            logging.error(f"Health check: DB unavailable: {e}")
+            checks["db"] = False
+    ok = all(v for k, v in checks.items() if k != "loop_lag_ms")
+    return web.json_response(checks, status=200 if ok else 503)
+
 async def main():
+    metrics.start_loop_monitor()
+    if os.getenv("DATABASE_URL"):
+        from app.services import db
+        db.start_connecting()
+    await inventory.start()
+    outbox.init_outbox()
+    sheets_writer.start_writer(SHEET_ID)
+    outbox.start_drainer(upload_to_drive_and_save_row)
+    broadcast.schedule_motivation()
+    await broadcast.start(bot)
+    metrics.startup_phase("services")
+
     app = web.Application()
     app.router.add_get('/', handle)
+    app.router.add_get('/stats', handle_stats)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_health)
+    if webhook.WEBHOOK_URL:
+        webhook.setup_webhook(app, dp, bot)
     runner = web.AppRunner(app)
     await runner.setup()
     await web.TCPSite(runner, '0.0.0.0', PORT).start()
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics.startup_phase("http")
+    # Google нужен только выгрузке заявок — клиенты поднимаются в фоне, пока идет поллинг
+    google_warm_up = asyncio.create_task(google_api.warm_up())
+    try:
+        if webhook.WEBHOOK_URL:
+            # aiogram ловит SIGTERM только в start_polling; без этого деплой убьет процесс
+            # мимо finally и принятые, но не обработанные апдейты потеряются
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        else:
+            # Апдейты, пришедшие во время деплоя, не выбрасываем
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
+    finally:
+        google_warm_up.cancel()
+        if os.getenv("DATABASE_URL"):
+            from app.services import db
+            await db.stop_connecting()
+        await runner.cleanup()
+        await broadcast.stop()
+        await outbox.stop_drainer()
+        await sheets_writer.stop_writer()
+        await inventory.stop()
+        await dp.storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main())